@@ -0,0 +1,41 @@
+import asyncio
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from file_image import ingestWorker
+from model import Image
+
+class AsyncUploader:
+    def __init__(self, executor = None, max_in_flight = 8):
+        # executor None means the loop's default thread pool
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        # a semaphore belongs to the loop it was first used on, so keep one per loop
+        self.semaphores = WeakKeyDictionary()
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        async with semaphore:
+            return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def uploadFromFile(self, img, source_file):
+        # ORM objects stay on the loop thread, only the file work runs in the executor
+        result = await self.run(ingestWorker, img.ingestJob(source_file))
+        if not result or not result.thumb_info:
+            return False
+        img.setFileInfo(result.image_info, result.thumb_info)
+        return True
+
+    async def uploadFromFiles(self, image_type, source_files):
+        images = [Image(image_type) for source_file in source_files]
+        results = await asyncio.gather(*[self.uploadFromFile(img, source_file)\
+                for (img, source_file) in zip(images, source_files)])
+        return [img if ret else None for (img, ret) in zip(images, results)]
+
+    async def mkDefThumb(self, image_type):
+        info = await self.run(image_type.mkDefThumbInfo, image_type.max_thumb_width,\
+                image_type.max_thumb_height, image_type.base_dir)
+        return image_type.setDefThumb(info)
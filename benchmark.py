@@ -0,0 +1,215 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+from os import path
+from tempfile import mkdtemp
+from datetime import datetime, timedelta
+
+import conn
+from file_image import FileProcess, ImageInfo, ImageTransform, mkTempFile
+from model import metadata, Event, EventType, Image, ImageType, Place, Person
+import Image as PilImage
+
+IMAGE_SIZES = {
+    'small': (320, 240),
+    'medium': (1600, 1200),
+    'large': (4000, 3000)
+}
+
+IMPORT_CASES = {
+    'import.file_image': 'import file_image',
+    'import.model': 'import model',
+    'import.model_startup': 'import model; model.startup()',
+    'import.conn': 'import conn'
+}
+
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+    'gif': ('GIF', '.gif')
+}
+
+def mkSourceImage(work_dir, size_name, format_name):
+    (width, height) = IMAGE_SIZES[size_name]
+    (pil_format, ext) = IMAGE_FORMATS[format_name]
+    im = PilImage.new('RGB', (width, height))
+    # a gradient compresses like a photo far better than a flat colour does
+    step = max(width // 64, 1)
+    for x in range(0, width, step):
+        im.paste((x * 255 // width, 128, 255 - x * 255 // width), (x, 0, min(x + step, width), height))
+    file_path = path.join(work_dir, '%s-%s%s' % (size_name, format_name, ext))
+    im.save(file_path, pil_format)
+    return file_path
+
+def timeLoop(func, number):
+    start = time.perf_counter()
+    for v in range(number):
+        func()
+    return time.perf_counter() - start
+
+def timeCase(func, repeat, min_time = 0.2):
+    # like timeit's autorange: loop fast cases until a sample is far above the timer resolution,
+    # the calibrating run is the first sample
+    number = 1
+    while True:
+        elapsed = timeLoop(func, number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed * 10 < min_time else 2
+    times = [elapsed / number]
+    for v in range(repeat - 1):
+        times.append(timeLoop(func, number) / number)
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'repeat': repeat,
+        'number': number
+    }
+
+class Benchmark:
+    def __init__(self, repeat = 5, events = 1000, sizes = None, formats = None):
+        self.repeat = repeat
+        self.events = events
+        self.sizes = sizes or sorted(IMAGE_SIZES.keys())
+        self.formats = formats or sorted(IMAGE_FORMATS.keys())
+        self.results = {}
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        FileProcess.base_dir = path.join(self.work_dir, 'store')
+        FileProcess.img_subdir = 'img'
+        FileProcess.known_dirs.clear()
+        shutil.os.mkdir(FileProcess.base_dir)
+        conn.configure(url = 'sqlite:///' + path.join(self.work_dir, 'bench.sqlite'))
+        self.session = conn.Session()
+        metadata.create_all(conn.engine)
+        self.sources = {}
+        for size_name in self.sizes:
+            for format_name in self.formats:
+                self.sources[(size_name, format_name)] = mkSourceImage(self.work_dir, size_name, format_name)
+
+    def tearDown(self):
+        conn.Session.remove()
+        shutil.rmtree(self.work_dir)
+
+    def add(self, name, func, repeat = None, min_time = 0.2):
+        self.results[name] = timeCase(func, repeat or self.repeat, min_time)
+        sys.stderr.write('%-40s %10.3f ms\n' % (name, self.results[name]['median'] * 1000))
+
+    def runImages(self):
+        fp = FileProcess()
+        transform = ImageTransform.create(ImageTransform.STD, 126, 126)
+        text_file = mkTempFile('x' * 65536)
+        self.add('file.copyFile', lambda: fp.copyFile(text_file, ext = '.txt'))
+        for ((size_name, format_name), source) in sorted(self.sources.items()):
+            key = '%s.%s' % (size_name, format_name)
+            def probeCold():
+                ImageInfo.probe_cache.clear()
+                ImageInfo(source)
+            self.add('probe.cold.' + key, probeCold)
+            self.add('probe.warm.' + key, lambda: ImageInfo(source))
+            target = path.join(self.work_dir, 'thumb-' + path.basename(source))
+            self.add('transform.std.' + key, lambda: transform.process(source, target))
+            self.add('file.copyImage.' + key, lambda: fp.copyImage(source, transform = transform))
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_width = 126
+        it.max_thumb_height = 126
+        it.transform_type = ImageTransform.STD
+        for ((size_name, format_name), source) in sorted(self.sources.items()):
+            self.add('image.uploadFromFile.%s.%s' % (size_name, format_name),\
+                    lambda: Image(it).uploadFromFile(source))
+
+    def runEvents(self):
+        session = self.session
+        et = EventType('bench', 'Bench')
+        places = [Place('Bench place %d' % v) for v in range(20)]
+        persons = [Person('Bench person %d' % v, Person.MUSICIAN) for v in range(50)]
+        session.add_all([et] + places + persons)
+        session.commit()
+        start = datetime(2000, 1, 1, 20, 0)
+        counter = [0]
+        def insertEvents():
+            for v in range(self.events):
+                n = counter[0] = counter[0] + 1
+                e = Event(et, 'Bench event %d' % n)
+                e.time_start = start + timedelta(hours = n)
+                e.place = places[n % len(places)]
+                e.persons.append(persons[n % len(persons)])
+                session.add(e)
+            session.commit()
+        # runs once, the listing cases below depend on how many events there are
+        self.add('event.insert.%d' % self.events, insertEvents, repeat = 1, min_time = 0)
+        def listEvents():
+            session.expire_all()
+            for e in Event.listing(session, event_type = et, date_from = start,\
+                    date_to = start + timedelta(days = 7)):
+                (e.place.title_name, [p.name for p in e.persons])
+        self.add('event.listing.week', listEvents)
+        self.add('event.stream.%d' % self.events,\
+                lambda: [r for r in Event.stream(session, chunk_size = 500, rows = True)])
+
+    def runImports(self):
+        # every case pays the interpreter start, so subtract a bare one
+        bare = timeCase(lambda: subprocess.check_call([sys.executable, '-c', 'pass']), self.repeat)['median']
+        for (name, code) in sorted(IMPORT_CASES.items()):
+            result = timeCase(lambda: subprocess.check_call([sys.executable, '-W', 'ignore', '-c', code]),\
+                    self.repeat)
+            for key in ('min', 'median', 'mean'):
+                result[key] = max(result[key] - bare, 0)
+            self.results[name] = result
+            sys.stderr.write('%-40s %10.3f ms\n' % (name, result['median'] * 1000))
+
+    def run(self):
+        self.runImports()
+        self.setUp()
+        try:
+            self.runImages()
+            self.runEvents()
+        finally:
+            self.tearDown()
+        return self.results
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if not name in baseline:
+            continue
+        base = baseline[name]['median']
+        if base > 0 and result['median'] > base * (1 + threshold):
+            regressions.append((name, base, result['median']))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark image ingest, transforms and event queries')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--events', type = int, default = 1000)
+    parser.add_argument('--sizes', default = ','.join(sorted(IMAGE_SIZES.keys())))
+    parser.add_argument('--formats', default = ','.join(sorted(IMAGE_FORMATS.keys())))
+    parser.add_argument('--output', default = 'bench_results.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type = float, default = 0.2)
+    args = parser.parse_args(argv)
+
+    bench = Benchmark(repeat = args.repeat, events = args.events, sizes = args.sizes.split(','),\
+            formats = args.formats.split(','))
+    results = bench.run()
+    with open(args.output, 'w') as f:
+        json.dump({'results': results, 'time': time.time(), 'python': sys.version}, f, indent = 2,\
+                sort_keys = True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for (name, base, median) in regressions:
+            sys.stderr.write('REGRESSION %s: %.3f ms -> %.3f ms\n' % (name, base * 1000, median * 1000))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
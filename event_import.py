@@ -0,0 +1,190 @@
+import sys
+import json
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy import bindparam
+
+from model import Event, EventType, Place, Person, Link, LinkDomain, EventSourceType, event_persons,\
+        event_links, insertMissing
+import search
+
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+def parseTime(value):
+    if not value:
+        return None
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("Cant parse time '%s'" % value)
+
+def chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+class KeyCache:
+    def __init__(self, key_column, id_column, mk_row = None):
+        self.table = key_column.table
+        self.key_column = key_column
+        self.id_column = id_column
+        if mk_row is None:
+            mk_row = lambda key: {key_column.name: key}
+        self.mk_row = mk_row
+        self.ids = {}
+        self.created = []
+
+    def load(self, session, keys):
+        for part in chunks(keys, 500):
+            q = session.query(self.id_column, self.key_column).filter(self.key_column.in_(part))
+            for (row_id, key) in q:
+                self.ids[key] = row_id
+
+    def resolve(self, session, keys):
+        missing = set([k for k in keys if k and not k in self.ids])
+        if missing:
+            self.load(session, missing)
+            missing = [k for k in missing if not k in self.ids]
+            if missing:
+                insertMissing(session.connection(), self.table, [self.mk_row(k) for k in missing])
+                self.load(session, missing)
+                self.created.extend([self.ids[k] for k in missing if k in self.ids])
+        return self.ids
+
+class EventImporter:
+    source_types = {
+        'lastfm': EventSourceType.LASTFM,
+        'vk': EventSourceType.VK
+    }
+
+    def __init__(self, session, source_type, batch_size = 500, index = None):
+        self.session = session
+        self.source_type = source_type
+        self.batch_size = batch_size
+        if index is None:
+            index = search.installed()
+        self.index = index
+        self.places = KeyCache(Place.__table__.c.title_name, Place.__table__.c.place_id)
+        self.persons = KeyCache(Person.__table__.c.name, Person.__table__.c.person_id,\
+                lambda name: {'name': name, 'person_type': Person.MUSICIAN})
+        self.event_types = KeyCache(EventType.__table__.c.name, EventType.__table__.c.event_type_id,\
+                lambda name: {'name': name, 'title': name})
+        self.links = KeyCache(Link.__table__.c.url, Link.__table__.c.link_id,\
+                lambda url: {'url': url, 'link_type': Link.TYPE_STD,\
+                        'domain_id': self.link_domains.get(url)})
+        self.link_domains = {}
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def importFile(self, file_name):
+        with open(file_name) as f:
+            return self.importLines(f)
+
+    def importLines(self, lines):
+        batch = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not record.get('source_url'):
+                self.skipped += 1
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self.importBatch(batch)
+                batch = []
+        if batch:
+            self.importBatch(batch)
+        return self
+
+    def eventRow(self, record, places, event_types):
+        return {
+            'title': record.get('title') or '',
+            'description': record.get('description'),
+            'time_start': parseTime(record.get('time_start')),
+            'time_end': parseTime(record.get('time_end')),
+            'place_id': places.get(record.get('place')),
+            'event_type_id': event_types.get(record.get('event_type')),
+            'source_type': self.source_type,
+            'source_url': record['source_url']
+        }
+
+    def findEventIds(self, source_urls):
+        events = Event.__table__
+        ret = {}
+        for part in chunks(source_urls, 500):
+            q = self.session.query(events.c.source_url, events.c.event_id).\
+                    filter(events.c.source_url.in_(part))
+            ret.update(dict(q))
+        return ret
+
+    def importBatch(self, records):
+        session = self.session
+        events = Event.__table__
+        records = list(OrderedDict([(r['source_url'], r) for r in records]).values())
+        places = self.places.resolve(session, [r.get('place') for r in records])
+        event_types = self.event_types.resolve(session, [r.get('event_type') for r in records])
+        persons = self.persons.resolve(session, [p for r in records for p in r.get('persons') or []])
+        urls = [l for r in records for l in r.get('links') or []]
+        self.link_domains = LinkDomain.resolveUrls(session, [l for l in urls if not l in self.links.ids])
+        links = self.links.resolve(session, urls)
+
+        source_urls = [r['source_url'] for r in records]
+        existing = self.findEventIds(source_urls)
+        new_rows = []
+        update_rows = []
+        for record in records:
+            row = self.eventRow(record, places, event_types)
+            if row['source_url'] in existing:
+                row['b_event_id'] = existing[row['source_url']]
+                update_rows.append(row)
+            else:
+                new_rows.append(row)
+        if new_rows:
+            session.execute(events.insert(), new_rows)
+        if update_rows:
+            session.execute(events.update().where(events.c.event_id == bindparam('b_event_id')),\
+                    update_rows)
+            for part in chunks(existing.values(), 500):
+                session.execute(event_persons.delete().where(event_persons.c.event_id.in_(part)))
+                session.execute(event_links.delete().where(event_links.c.event_id.in_(part)))
+
+        event_ids = self.findEventIds(source_urls)
+        person_rows = []
+        link_rows = []
+        for record in records:
+            event_id = event_ids[record['source_url']]
+            for (order, name) in enumerate(record.get('persons') or []):
+                person_rows.append({'event_id': event_id, 'person_id': persons[name], 'order': order})
+            for (order, url) in enumerate(record.get('links') or []):
+                link_rows.append({'event_id': event_id, 'link_id': links[url], 'order': order})
+        if person_rows:
+            session.execute(event_persons.insert(), person_rows)
+        if link_rows:
+            session.execute(event_links.insert(), link_rows)
+        if self.index:
+            self.indexBatch(event_ids.values())
+        session.commit()
+        self.inserted += len(new_rows)
+        self.updated += len(update_rows)
+
+    def indexBatch(self, event_ids):
+        # Core inserts bypass the search flush listener
+        search.updateDocs(self.session, Event, event_ids)
+        for (cls, cache) in ((Place, self.places), (Person, self.persons)):
+            search.updateDocs(self.session, cls, cache.created)
+            cache.created = []
+
+if __name__ == '__main__':
+    from conn import session
+    if len(sys.argv) < 3 or not sys.argv[1] in EventImporter.source_types:
+        print('usage: event_import.py lastfm|vk FILE...')
+        sys.exit(1)
+    importer = EventImporter(session, EventImporter.source_types[sys.argv[1]])
+    for file_name in sys.argv[2:]:
+        importer.importFile(file_name)
+    print('inserted %d, updated %d, skipped %d' % (importer.inserted, importer.updated, importer.skipped))
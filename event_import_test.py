@@ -0,0 +1,81 @@
+import unittest
+import json
+
+from event_import import EventImporter, parseTime
+from model import Event, EventSourceType, Place, Person, Link, event_persons
+from conn import session
+from datetime import datetime
+
+def mkLines(records):
+    return [json.dumps(r) for r in records]
+
+class TestEventImport(unittest.TestCase):
+    def setUp(self):
+        self.records = [{
+            'source_url': 'http://last.fm/event/1',
+            'title': 'First concert',
+            'time_start': '2012-05-01 20:00:00',
+            'event_type': 'live',
+            'place': 'Import club',
+            'persons': ['Import band', 'Import support'],
+            'links': ['http://last.fm/event/1', 'http://vk.com/event1']
+        }, {
+            'source_url': 'http://last.fm/event/2',
+            'title': 'Second concert',
+            'time_start': '2012-05-02',
+            'event_type': 'live',
+            'place': 'Import club',
+            'persons': ['Import support']
+        }]
+
+    def tearDown(self):
+        session.rollback()
+        events = session.query(Event).filter(Event.source_url.like('http://last.fm/event/%'))
+        for e in events:
+            e.persons = []
+            e.links = []
+            session.delete(e)
+        session.query(Person).filter(Person.name.like('Import %')).delete(synchronize_session=False)
+        session.query(Place).filter(Place.title_name == 'Import club').delete(synchronize_session=False)
+        session.query(Link).filter(Link.url.like('http://%event%1')).delete(synchronize_session=False)
+        session.commit()
+
+    def testParseTime(self):
+        self.assertEquals(parseTime('2012-05-01T20:30:00'), datetime(2012, 5, 1, 20, 30))
+        self.assertEquals(parseTime('2012-05-01'), datetime(2012, 5, 1))
+        self.assertEquals(parseTime(None), None)
+        self.assertRaises(ValueError, parseTime, 'tomorrow')
+
+    def testImport(self):
+        importer = EventImporter(session, EventSourceType.LASTFM, batch_size = 1)
+        importer.importLines(mkLines(self.records) + ['', json.dumps({'title': 'No url'})])
+        self.assertEquals((importer.inserted, importer.updated, importer.skipped), (2, 0, 1))
+
+        e = session.query(Event).filter(Event.source_url == 'http://last.fm/event/1').one()
+        self.assertEquals(e.title, 'First concert')
+        self.assertEquals(e.time_start, datetime(2012, 5, 1, 20, 0))
+        self.assertEquals(e.source_type, EventSourceType.LASTFM)
+        self.assertEquals(e.event_type.name, 'live')
+        self.assertEquals(e.place.title_name, 'Import club')
+        orders = session.query(Person.name, event_persons.c.order).\
+                join(event_persons, event_persons.c.person_id == Person.person_id).\
+                filter(event_persons.c.event_id == e.event_id).order_by(event_persons.c.order).all()
+        self.assertEquals([tuple(v) for v in orders], [('Import band', 0), ('Import support', 1)])
+        self.assertEquals(sorted([l.url for l in e.links]), sorted(self.records[0]['links']))
+        self.assertEquals(sorted([l.link_domain.domain for l in e.links]), ['last.fm', 'vk.com'])
+        self.assertEquals(session.query(Place).filter(Place.title_name == 'Import club').count(), 1)
+
+        self.records[0]['title'] = 'First concert moved'
+        self.records[0]['persons'] = ['Import support']
+        importer = EventImporter(session, EventSourceType.LASTFM)
+        importer.importLines(mkLines(self.records))
+        self.assertEquals((importer.inserted, importer.updated), (0, 2))
+        session.expire_all()
+        events = session.query(Event).filter(Event.source_url == 'http://last.fm/event/1').all()
+        self.assertEquals(len(events), 1)
+        self.assertEquals(events[0].title, 'First concert moved')
+        self.assertEquals([p.name for p in events[0].persons], ['Import support'])
+        self.assertEquals(session.query(Person).filter(Person.name == 'Import support').count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,38 @@
-from os import path,mkdir,fdopen
+from os import path,mkdir,fdopen,close,rename,unlink,walk,stat,utime
 from shutil import copyfile
 from random import randint
 from tempfile import mkdtemp, mkstemp 
-import Image
-import ImageDraw
+from copy import copy
+from importlib import import_module
+from threading import Thread, Lock
+from collections import OrderedDict
+from io import BytesIO
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+import hashlib
+import struct
+import errno
+
+from pack_store import PackStore, isPackRef
+from metrics import registry as metrics, timed, fileSize
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = import_module(self.__dict__['_name'])
+        return getattr(module, attr)
+
+# PIL and multiprocessing are only loaded once an image is actually touched
+Image = LazyModule('Image')
+ImageDraw = LazyModule('ImageDraw')
+multiprocessing = LazyModule('multiprocessing')
 
 def mkTempFile(content = None):
     (fd, source_file) = mkstemp()
@@ -25,13 +54,70 @@ def mkImageWithFrame(x, y, width=1, frame_color=None, bg_color=None):
     im.save(out_file, 'JPEG')
     return ImageInfo(out_file)
 
+def writeData(file_path, data):
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+def openImage(file_path):
+    try:
+        return Image.open(file_path)
+    except IOError:
+        return None
+
+def fileDigest(file_path):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
 class FileImageException(Exception):
     pass
 
+class IngestResult:
+    def __init__(self, source_file, image_info = None, thumb_info = None, error = None):
+        self.source_file = source_file
+        self.image_info = image_info
+        self.thumb_info = thumb_info
+        self.error = error
+
+    def __bool__(self):
+        return self.error is None
+
+def ingestWorker(job):
+    (settings, source_file, transform, short_dir, profile) = job
+    try:
+        fp = FileProcess(settings)
+        (image_info, thumb_info) = fp.ingestImage(source_file, transform = transform,\
+                short_dir = short_dir, profile = profile)
+    except Exception as e:
+        return IngestResult(source_file, error = str(e))
+    if image_info is None:
+        return IngestResult(source_file, error = 'Cant ingest image')
+    return IngestResult(source_file, image_info, thumb_info)
+
 class FileProcess:
+    STORE_RANDOM = 1
+    STORE_HASH = 2
+
     base_dir = path.realpath(path.curdir)
     base_url = ''
     img_subdir = None
+    storage = STORE_RANDOM
+    hash_levels = 2
+    dir_levels = 1
+    known_dirs = set()
+    file_remover = None
+    rendition_cache = None
+    pack_thumbs = False
+    pack_dir = 'packs'
+    pack_store = None
+
+    # what a worker needs to store files like its parent, spawned processes don't inherit class changes
+    SETTINGS = ('base_dir', 'img_subdir', 'storage', 'hash_levels', 'dir_levels', 'pack_thumbs', 'pack_dir')
 
     @staticmethod
     def fullPath(file_path):
@@ -49,57 +135,490 @@ class FileProcess:
         ii.short_path = image_path
         return ii
 
-    def __init__(self):
+    @staticmethod
+    def readFile(file_path):
+        if isPackRef(file_path):
+            return FileProcess.packStore().read(file_path)
+        with open(FileProcess.fullPath(file_path), 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def removeFile(file_path):
+        if isPackRef(file_path):
+            FileProcess.packStore().remove(file_path)
+            metrics.inc('files_removed')
+            return
+        full_path = FileProcess.fullPath(file_path)
+        if path.isfile(full_path):
+            metrics.inc('file_bytes_removed', fileSize(full_path))
+            unlink(full_path)
+            metrics.inc('files_removed')
+
+    @staticmethod
+    @timed('file_remove')
+    def removeFiles(files):
+        for file_path in files:
+            try:
+                FileProcess.removeFile(file_path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def removeFilesLater(files):
+        if FileProcess.file_remover is None:
+            FileProcess.removeFiles(files)
+        else:
+            FileProcess.file_remover.put(files)
+
+    @staticmethod
+    def startFileRemover():
+        if FileProcess.file_remover is None:
+            FileProcess.file_remover = FileRemover()
+            FileProcess.file_remover.start()
+        return FileProcess.file_remover
+
+    @staticmethod
+    def renditionCache():
+        if FileProcess.rendition_cache is None:
+            FileProcess.rendition_cache = RenditionCache()
+        return FileProcess.rendition_cache
+
+    @staticmethod
+    def packStore(pack_dir = None):
+        if pack_dir is None:
+            pack_dir = FileProcess.fullPath(FileProcess.pack_dir)
+        store = FileProcess.pack_store
+        if store is None or store.pack_dir != pack_dir:
+            store = FileProcess.pack_store = PackStore(pack_dir)
+        return store
+
+    def __init__(self, settings = None):
+        # worker threads and processes get their settings passed instead of changing the class defaults
+        if settings:
+            for key in self.SETTINGS:
+                if key in settings:
+                    setattr(self, key, settings[key])
         self.dir_max = 99
         self.file_max = 999999999
 
+    def settings(self):
+        return dict([(key, getattr(self, key)) for key in self.SETTINGS])
+
+    def targetPath(self, file_path):
+        return path.join(self.base_dir, str(file_path))
+
+    def removeTarget(self, file_path):
+        try:
+            if isPackRef(file_path):
+                FileProcess.packStore(self.targetPath(self.pack_dir)).remove(file_path)
+            else:
+                unlink(self.targetPath(file_path))
+        except OSError:
+            pass
+
+    def makeDirs(self, p):
+        self.writeTarget(p, lambda: self.makeKnownDirs(p))
+
+    def makeKnownDirs(self, p):
+        known_dirs = FileProcess.known_dirs
+        for pp in [p[0:v] for v in range(1,len(p)+1)]:
+            full_dir = self.targetPath(path.join(*pp))
+            if full_dir in known_dirs:
+                continue
+            try:
+                mkdir(full_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            known_dirs.add(full_dir)
+
+    def writeTarget(self, p, write_func):
+        try:
+            write_func()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # directory was removed behind our back, forget what we know
+            FileProcess.known_dirs.clear()
+            self.makeKnownDirs(p)
+            write_func()
+
+    def randomDirs(self, levels = None):
+        if levels is None:
+            levels = self.dir_levels
+        return [str(randint(1, self.dir_max)) for v in range(levels)]
+
+    @timed('file_copy')
     def copyFile(self, source_file, copy_func = None, short_dir = None, ext = None):
         if not path.isfile(source_file):
             raise FileImageException('Cant find source file')
         if ext is None:
             (_, ext) = path.splitext(source_file)
+        if self.storage == FileProcess.STORE_HASH:
+            return self.copyFileHash(source_file, copy_func, short_dir, ext)
         while True:
             p = []
             if short_dir:
                 p.extend(short_dir.split(path.sep))
-            p.append(str(randint(1, self.dir_max)))
-            for pp in [p[0:v] for v in range(1,len(p)+1)]:
-                rand_dir = self.fullPath(path.join(*pp))
-                if not path.isdir(rand_dir):
-                    mkdir(rand_dir)
+            p.extend(self.randomDirs())
+            self.makeDirs(p)
             p.append(str(randint(1, self.file_max)) + str(ext))
             target_file = path.join(*p) 
-            full_target_path = self.fullPath(target_file)
+            full_target_path = self.targetPath(target_file)
             if not path.isfile(full_target_path):
                 break;
         if copy_func is None:
+            metrics.inc('file_bytes_read', fileSize(source_file))
             copy_func = copyfile
-        copy_func(source_file, full_target_path)
+        self.writeTarget(p[:-1], lambda: copy_func(source_file, full_target_path))
+        metrics.inc('file_bytes_written', fileSize(full_target_path))
         return target_file
 
-    def copyImage(self, source_file, transform = None, short_dir = None): 
-        source_info = ImageInfo(source_file)
-        if not source_info.is_image():
-            return None
-        if transform is None:
-            copy_func = None
+    def copyFileHash(self, source_file, copy_func, short_dir, ext):
+        temp_file = None
+        if copy_func is None:
+            digest = fileDigest(source_file)
         else:
-            copy_func = lambda source, target: transform.process(source, target)
+            temp_file = self.mkTempTarget(ext)
+            copy_func(source_file, temp_file)
+            digest = fileDigest(temp_file)
+        p = []
+        if short_dir:
+            p.extend(short_dir.split(path.sep))
+        p.extend([digest[2 * v:2 * v + 2] for v in range(self.hash_levels)])
+        self.makeDirs(p)
+        p.append(digest + str(ext))
+        target_file = path.join(*p)
+        full_target_path = self.targetPath(target_file)
+        if path.isfile(full_target_path):
+            if not temp_file is None:
+                unlink(temp_file)
+            # a reused file is new to its next row, keep the file GC's grace period from expiring on it
+            utime(full_target_path, None)
+            return target_file
+        if temp_file is None:
+            metrics.inc('file_bytes_read', fileSize(source_file))
+            temp_file = self.mkTempTarget(ext)
+            copyfile(source_file, temp_file)
+        self.writeTarget(p[:-1], lambda: rename(temp_file, full_target_path))
+        metrics.inc('file_bytes_written', fileSize(full_target_path))
+        return target_file
+
+    def mkTempTarget(self, ext):
+        (fd, temp_file) = mkstemp(suffix = str(ext), dir = self.base_dir)
+        close(fd)
+        return temp_file
+
+    def imageDir(self, short_dir = None):
         p = [v for v in [self.img_subdir, short_dir] if v]
         if p:
-            short_dir = path.join(*p)
-        #print source_info.content_type
-        target_file = self.copyFile(source_file, copy_func = copy_func, short_dir = short_dir,\
-                ext = source_info.file_ext)
-        return FileProcess.imageInfo(target_file)
+            return path.join(*p)
+        return None
+
+    def storeImage(self, source_file, source_info, short_dir = None):
+        target_file = self.copyFile(source_file, short_dir = short_dir, ext = source_info.file_ext)
+        return source_info.withPath(self.targetPath(target_file), target_file)
+
+    def storeThumb(self, source_file, im, source_info, transform, short_dir = None, profile = None):
+        if profile is None:
+            profile = EncodingProfile.default
+        content_type = profile.contentType(source_info.content_type)
+        try:
+            (thumb, data) = self.encodeThumb(im, transform, profile, content_type)
+            if self.pack_thumbs:
+                return self.packThumb(thumb, data, content_type)
+            copy_func = lambda source, target: writeData(target, data)
+            target_file = self.copyFile(source_file, copy_func = copy_func, short_dir = short_dir,\
+                    ext = ImageInfo.file_exts[content_type])
+        except IOError:
+            return None
+        info = ImageInfo(self.targetPath(target_file), thumb, content_type)
+        info.short_path = target_file
+        return info
+
+    @timed('thumb_encode')
+    def encodeThumb(self, im, transform, profile, content_type):
+        thumb = transform.transformImage(im)
+        return (thumb, profile.encode(thumb, content_type, im.info))
+
+    def packThumb(self, thumb, data, content_type):
+        key = None
+        if self.storage == FileProcess.STORE_HASH:
+            key = hashlib.sha1(data).digest()
+        ref = FileProcess.packStore(self.targetPath(self.pack_dir)).put(data, key)
+        metrics.inc('pack_bytes_written', len(data))
+        info = ImageInfo(ref, thumb, content_type)
+        info.short_path = ref
+        return info
+
+    @timed('image_copy')
+    def copyImage(self, source_file, transform = None, short_dir = None, profile = None): 
+        im = openImage(source_file)
+        if im is None:
+            return None
+        source_info = ImageInfo(source_file, im)
+        if not source_info.is_image():
+            return None
+        short_dir = self.imageDir(short_dir)
+        if transform is None:
+            return self.storeImage(source_file, source_info, short_dir)
+        return self.storeThumb(source_file, im, source_info, transform, short_dir, profile)
+
+    @timed('image_ingest')
+    def ingestImage(self, source_file, transform = None, short_dir = None, profile = None):
+        im = openImage(source_file)
+        if im is None:
+            return (None, None)
+        source_info = ImageInfo(source_file, im)
+        if not source_info.is_image():
+            return (None, None)
+        short_dir = self.imageDir(short_dir)
+        thumb_info = None
+        if not transform is None:
+            thumb_info = self.storeThumb(source_file, im, source_info, transform, short_dir, profile)
+            if thumb_info is None:
+                return (None, None)
+        try:
+            image_info = self.storeImage(source_file, source_info, short_dir)
+        except (IOError, OSError, FileImageException):
+            # a hashed thumbnail may already be shared, the file GC takes care of those
+            if not thumb_info is None and self.storage != FileProcess.STORE_HASH:
+                self.removeTarget(thumb_info.short_path)
+            return (None, None)
+        return (image_info, thumb_info)
+
+    def ingestImages(self, source_files, transform = None, short_dir = None, processes = None,\
+            chunksize = 16, profile = None):
+        settings = self.settings()
+        jobs = [(settings, source_file, transform, short_dir, profile) for source_file in source_files]
+        if processes == 1:
+            return [ingestWorker(job) for job in jobs]
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(ingestWorker, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+class FileRemover(Thread):
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue()
+
+    def put(self, files):
+        self.queue.put(list(files))
+
+    def wait(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            files = self.queue.get()
+            try:
+                FileProcess.removeFiles(files)
+            finally:
+                self.queue.task_done()
+
+class RenditionCache:
+    def __init__(self, cache_dir = 'cache', max_bytes = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def loadEntries(self):
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        full_dir = FileProcess.fullPath(self.cache_dir)
+        files = []
+        for (dir_path, _, file_names) in walk(full_dir):
+            for file_name in file_names:
+                full_path = path.join(dir_path, file_name)
+                st = stat(full_path)
+                files.append((st.st_atime, path.relpath(full_path, FileProcess.base_dir), st.st_size))
+        for (_, short_path, size) in sorted(files):
+            self.entries[short_path] = size
+            self.total_bytes += size
+
+    def get(self, image_path, key, transform, profile = None):
+        if profile is None:
+            profile = EncodingProfile.default
+        (_, ext) = path.splitext(image_path)
+        if profile.content_type:
+            ext = ImageInfo.file_exts[profile.content_type]
+        name = hashlib.sha1(image_path.encode('utf-8')).hexdigest()
+        short_path = path.join(self.cache_dir, key, profile.cacheKey(), name[0:2], name + ext)
+        with self.lock:
+            if self.entries is None:
+                self.loadEntries()
+            size = self.entries.pop(short_path, None)
+            if not size is None:
+                if path.isfile(FileProcess.fullPath(short_path)):
+                    self.entries[short_path] = size
+                    self.hits += 1
+                    return short_path
+                # another process sharing the cache evicted it
+                self.total_bytes -= size
+            self.misses += 1
+        size = self.render(image_path, short_path, transform, profile)
+        if size is None:
+            return None
+        with self.lock:
+            if not short_path in self.entries:
+                self.entries[short_path] = size
+                self.total_bytes += size
+            self.evict()
+        return short_path
+
+    def render(self, image_path, short_path, transform, profile):
+        im = openImage(FileProcess.fullPath(image_path))
+        if im is None:
+            return None
+        content_type = profile.contentType(ImageInfo.pil_formats.get(im.format))
+        if content_type is None:
+            return None
+        fp = FileProcess()
+        fp.makeDirs(path.dirname(short_path).split(path.sep))
+        temp_file = fp.mkTempTarget(path.splitext(short_path)[1])
+        try:
+            writeData(temp_file, profile.encode(transform.transformImage(im), content_type, im.info))
+        except IOError:
+            unlink(temp_file)
+            return None
+        rename(temp_file, FileProcess.fullPath(short_path))
+        return stat(FileProcess.fullPath(short_path)).st_size
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            (short_path, size) = self.entries.popitem(last = False)
+            self.total_bytes -= size
+            self.evictions += 1
+            FileProcess.removeFiles([short_path])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'files': len(self.entries or []),
+            'bytes': self.total_bytes
+        }
+
+def resampleFilter(im):
+    if im.mode in ('1', 'P'):
+        return Image.NEAREST
+    return getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+
+class EncodingProfile:
+    def __init__(self, content_type = None, quality = None, progressive = False, optimize = False,\
+            strip_metadata = None, max_bytes = None, min_quality = 30):
+        self.content_type = content_type
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        # None leaves metadata handling to PIL, True drops EXIF and ICC, False copies them from the source
+        self.strip_metadata = strip_metadata
+        self.max_bytes = max_bytes
+        self.min_quality = min_quality
+
+    def contentType(self, source_type):
+        return self.content_type or source_type
+
+    def cacheKey(self):
+        # renditions encoded with other settings must not share cache files
+        settings = (self.content_type, self.quality, self.progressive, self.optimize, self.strip_metadata,\
+                self.max_bytes, self.min_quality)
+        return hashlib.sha1(repr(settings).encode('ascii')).hexdigest()[0:8]
+
+    def prepare(self, im, content_type):
+        if content_type == ImageInfo.JPEG and not im.mode in ('RGB', 'L', 'CMYK'):
+            return im.convert('RGB')
+        if content_type == ImageInfo.WEBP and not im.mode in ('RGB', 'RGBA'):
+            if 'A' in im.mode or 'transparency' in im.info:
+                return im.convert('RGBA')
+            return im.convert('RGB')
+        return im
+
+    def saveOptions(self, content_type, quality, info):
+        options = {}
+        if content_type in (ImageInfo.JPEG, ImageInfo.WEBP) and quality:
+            options['quality'] = quality
+        if content_type == ImageInfo.JPEG:
+            if self.progressive:
+                options['progressive'] = True
+            if self.optimize:
+                options['optimize'] = True
+        elif content_type == ImageInfo.PNG and self.optimize:
+            options['optimize'] = True
+        elif content_type == ImageInfo.WEBP and self.optimize:
+            options['method'] = 6
+        if self.strip_metadata:
+            options['icc_profile'] = None
+            options['exif'] = b''
+        elif self.strip_metadata == False and info:
+            for key in ('icc_profile', 'exif'):
+                if info.get(key):
+                    options[key] = info[key]
+        return options
+
+    def encodeQuality(self, im, content_type, quality, info):
+        buf = BytesIO()
+        im.save(buf, ImageInfo.pil_names[content_type], **self.saveOptions(content_type, quality, info))
+        return buf.getvalue()
+
+    def encode(self, im, content_type, info = None):
+        im = self.prepare(im, content_type)
+        if not self.max_bytes or not content_type in (ImageInfo.JPEG, ImageInfo.WEBP):
+            return self.encodeQuality(im, content_type, self.quality, info)
+        # largest quality that fits the budget, or the floor if nothing does
+        (low, high) = (self.min_quality, self.quality or 90)
+        data = self.encodeQuality(im, content_type, high, info)
+        if len(data) <= self.max_bytes:
+            return data
+        best = None
+        high -= 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = self.encodeQuality(im, content_type, quality, info)
+            if len(data) <= self.max_bytes:
+                best = data
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is None:
+            best = self.encodeQuality(im, content_type, self.min_quality, info)
+        return best
+
+EncodingProfile.default = EncodingProfile()
 
 class ImageTransform:
     STD = 1
+    CROP = 2
+    PAD = 3
+    WIDTH = 4
+
+    shared = {}
+
+    @staticmethod
+    def get(transform_type, width = None, height = None):
+        key = (transform_type, width, height)
+        it = ImageTransform.shared.get(key)
+        if it is None:
+            it = ImageTransform.shared[key] = ImageTransform.create(transform_type, width, height)
+        return it
     
     @staticmethod
     def create(transform_type, width = None, height = None):
         types = { 
-            ImageTransform.STD: ImageTransformStd 
+            ImageTransform.STD: ImageTransformStd,
+            ImageTransform.CROP: ImageTransformCrop,
+            ImageTransform.PAD: ImageTransformPad,
+            ImageTransform.WIDTH: ImageTransformWidth
         }
         if transform_type in types:
             it = types[transform_type]
@@ -111,64 +630,229 @@ class ImageTransform:
         self.width = width
         self.height = height
 
-    def process(self, source_file, target_file):
-        raise FileImageException('Cant process empty for this transfer type')
-
-class ImageTransformStd(ImageTransform):
+    @timed('transform_process')
     def process(self, source_file, target_file):
         try:
             i = Image.open(source_file)
-            (i_width, i_height) = i.size
-            i_ratio = float(i_width) / float(i_height)
-            #print i_ratio, i_width, i_height
-            ratio = float(self.width) / float(self.height)
-            if i_ratio < ratio:
-                h = self.height
-                w = int(self.height * i_ratio)
-            else:
-                w = self.width
-                h = int(float(self.width) / float(i_ratio))
-            i.resize((w, h)).save(target_file)
+            self.transformImage(i).save(target_file)
         except IOError:
             return False
+        metrics.inc('transform_bytes_read', fileSize(source_file))
+        metrics.inc('transform_bytes_written', fileSize(target_file))
         return True
 
-class ImageInfo:
+    def transformImage(self, im):
+        raise FileImageException('Cant process empty for this transfer type')
+
+    def fitSize(self, size):
+        (i_width, i_height) = size
+        i_ratio = float(i_width) / float(i_height)
+        #print i_ratio, i_width, i_height
+        ratio = float(self.width) / float(self.height)
+        if i_ratio < ratio:
+            h = self.height
+            w = int(self.height * i_ratio)
+        else:
+            w = self.width
+            h = int(float(self.width) / float(i_ratio))
+        return (max(w, 1), max(h, 1))
+
+    def scale(self, im, size):
+        # JPEG decoder can skip most of the work when asked for a reduced scale
+        im.draft(im.mode, size)
+        return im.resize(size, resampleFilter(im))
+
+class ImageTransformStd(ImageTransform):
+    def transformImage(self, i):
+        return self.scale(i, self.fitSize(i.size))
+
+class ImageTransformCrop(ImageTransform):
+    def transformImage(self, i):
+        (i_width, i_height) = i.size
+        k = max(float(self.width) / i_width, float(self.height) / i_height)
+        i.draft(i.mode, (int(i_width * k), int(i_height * k)))
+        (i_width, i_height) = i.size
+        k = max(float(self.width) / i_width, float(self.height) / i_height)
+        (w, h) = (min(int(round(self.width / k)), i_width), min(int(round(self.height / k)), i_height))
+        left = (i_width - w) // 2
+        top = (i_height - h) // 2
+        i = i.crop((left, top, left + w, top + h))
+        return i.resize((self.width, self.height), resampleFilter(i))
+
+class ImageTransformPad(ImageTransform):
+    bg_color = (0xff, 0xff, 0xff)
+
+    def transformImage(self, i):
+        thumb = self.scale(i, self.fitSize(i.size))
+        mode = 'RGB'
+        bg_color = self.bg_color
+        if 'A' in thumb.mode:
+            mode = 'RGBA'
+            bg_color = bg_color + (0,)
+        if thumb.mode != mode:
+            thumb = thumb.convert(mode)
+        im = Image.new(mode, (self.width, self.height), bg_color)
+        (w, h) = thumb.size
+        im.paste(thumb, ((self.width - w) // 2, (self.height - h) // 2))
+        return im
+
+class ImageTransformWidth(ImageTransform):
+    def transformImage(self, i):
+        (i_width, i_height) = i.size
+        h = max(int(float(self.width) * i_height / i_width), 1)
+        return self.scale(i, (self.width, h))
+
+JPEG_SOF_MARKERS = set([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+JPEG_BARE_MARKERS = set([0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8])
+
+def probeJpeg(f):
+    while True:
+        b = f.read(1)
+        if not b:
+            return None
+        if b != b'\xff':
+            continue
+        marker = ord(f.read(1) or b'\0')
+        while marker == 0xff:
+            marker = ord(f.read(1) or b'\0')
+        if marker in JPEG_BARE_MARKERS:
+            continue
+        if marker in (0x00, 0xd9, 0xda):
+            return None
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        (length,) = struct.unpack('>H', data)
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            (_, height, width) = struct.unpack('>BHH', data)
+            return (ImageInfo.JPEG, width, height)
+        f.seek(length - 2, 1)
+
+def probeWebp(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        (width, height) = struct.unpack('<HH', head[26:30])
+        return (ImageInfo.WEBP, width & 0x3fff, height & 0x3fff)
+    if chunk == b'VP8L' and head[20:21] == b'\x2f':
+        (bits,) = struct.unpack('<I', head[21:25])
+        return (ImageInfo.WEBP, (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+    if chunk == b'VP8X':
+        width = struct.unpack('<I', head[24:27] + b'\x00')[0] + 1
+        height = struct.unpack('<I', head[27:30] + b'\x00')[0] + 1
+        return (ImageInfo.WEBP, width, height)
+    return None
+
+def probeImage(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(30)
+            if head[0:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                (width, height) = struct.unpack('>II', head[16:24])
+                return (ImageInfo.PNG, width, height)
+            if head[0:6] in (b'GIF87a', b'GIF89a'):
+                (width, height) = struct.unpack('<HH', head[6:10])
+                return (ImageInfo.GIF, width, height)
+            if head[0:2] == b'\xff\xd8':
+                f.seek(2)
+                return probeJpeg(f)
+            if head[0:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return probeWebp(head)
+    except (IOError, struct.error):
+        pass
+    return None
+
+class ProbeCache:
+    def __init__(self, max_size = 10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def probe(self, file_path):
+        try:
+            st = stat(file_path)
+        except OSError:
+            return None
+        key = (file_path, st.st_mtime, st.st_size)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                ret = self.entries[key] = self.entries.pop(key)
+                return ret
+            self.misses += 1
+        ret = probeImage(file_path)
+        with self.lock:
+            self.entries[key] = ret
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+        return ret
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class ImageInfo(object):
     JPEG = 1
     GIF = 2 
     PNG = 3
+    WEBP = 4
 
     file_exts = {
         JPEG: '.jpg',
         GIF: '.gif',
-        PNG: '.png'
+        PNG: '.png',
+        WEBP: '.webp'
     }
 
     pil_formats = {
         'JPEG': JPEG,
         'GIF': GIF,
-        'PNG': PNG
+        'PNG': PNG,
+        'WEBP': WEBP
     }
 
-    def __init__(self, file_path):
+    pil_names = dict((v, k) for (k, v) in pil_formats.items())
+
+    probe_cache = ProbeCache()
+
+    __slots__ = ('file_path', 'width', 'height', 'content_type', 'short_path')
+
+    def __init__(self, file_path, image = None, content_type = None):
         self.file_path = file_path
         self.width = 0
         self.height = 0
-        self.content_type = None
-        self.initInfo()
-        if not path.isfile(self.file_path):
-            return
+        self.content_type = content_type
+        self.short_path = None
+        if image is None:
+            self.initInfo()
+        else:
+            self.initImageInfo(image)
 
+    @timed('image_info_probe')
     def initInfo(self):
-        try:
-            im = Image.open(self.file_path)
-            self.content_type = self.pil_formats[im.format]
-        except Exception as e:
-            #print str(e) + "\nfor file " + self.file_path
+        ret = ImageInfo.probe_cache.probe(self.file_path)
+        if ret is None:
             self.content_type = None
             return
+        (self.content_type, self.width, self.height) = ret
+
+    def initImageInfo(self, im):
+        if self.content_type is None:
+            self.content_type = self.pil_formats.get(im.format)
+        if self.content_type is None:
+            return
         (self.width, self.height) = im.size
 
+    def withPath(self, file_path, short_path = None):
+        info = copy(self)
+        info.file_path = file_path
+        info.short_path = short_path
+        return info
+
     @property
     def file_ext(self):
         try:
@@ -176,11 +860,7 @@ class ImageInfo:
         except NameError:
             raise FileImageException('Cant find file extension for this content type')
         except KeyError as e:
-<<<<<<< HEAD
-            raise e
-=======
             raise FileImageException("Cant find content_type \'%s\'" % self.content_type)
->>>>>>> ee07473ed0fd62f60355c74e6d5014b7e5665c5d
 
     def __bool__(self):
         return self.is_image()
@@ -1,13 +1,33 @@
 import unittest
 
-from file_image import FileProcess, ImageInfo, ImageTransform
-from model import Image, ImageType, EventSourceType, EventType, Event, Place, Person, EventStatus
-from conn import engine, session
+from file_image import FileProcess, ImageInfo, ImageTransform, RenditionCache, FileImageException,\
+        EncodingProfile, mkTempFile, mkImageWithFrame, ingestWorker
+from model import Image, ImageType, ImageRendition, EventSourceType, EventType, Event, Place, Person, EventStatus,\
+        ModelExteption, LinkDomain, EventStatusCount, sprite_images, dateRange, onDay,\
+        link_domain_index, FileRef, event_persons
+from conn import engine, session, Session, createEngine
+from threading import Thread
+from rebalance_files import rebalanceFiles
+from pack_store import PackStore, PackStoreException
+from pack_thumbs import migrateThumbs
+from async_upload import AsyncUploader
+from reencode_thumbs import reencodeThumbs
+from sprite import buildSprite, rebuildStale, packTiles
+from gc_files import FileGC, PathSet
+import metrics
 from tempfile import mkdtemp, mkstemp 
 from datetime import datetime, date
+from sqlalchemy import text
+from sqlalchemy import event as alchemy_event
 from sqlalchemy.orm import aliased
+from io import BytesIO
+import asyncio
+import subprocess
+import sys
+import json
 import os
 import shutil
+import Image as PilImage
 
 session.echo = False
 
@@ -33,6 +53,10 @@ class TestFileImage(unittest.TestCase):
         FileProcess.img_subdir = 'img'
 
     def tearDown(self):
+        FileProcess.storage = FileProcess.STORE_RANDOM
+        FileProcess.dir_levels = 1
+        FileProcess.pack_thumbs = False
+        FileProcess.pack_store = None
         shutil.rmtree(self.temp_dir)
 
     def testFileCopy(self):
@@ -47,6 +71,36 @@ class TestFileImage(unittest.TestCase):
         self.assertEquals(ext, '.txt')
         os.unlink(source_file)
 
+    def testFileCopyLevels(self):
+        FileProcess.dir_levels = 3
+        source_file = mkTempFile('Temp file')
+        fp = FileProcess()
+        target_file = fp.copyFile(source_file, short_dir = 's', ext = '.txt')
+        split_p = target_file.split(os.path.sep)
+        self.assertEquals(len(split_p), 5)
+        self.assert_(fp.fullPath(os.path.join(*split_p[0:4])) in FileProcess.known_dirs)
+        shutil.rmtree(fp.fullPath('s'))
+        target_file = fp.copyFile(source_file, short_dir = 's', ext = '.txt')
+        self.assertEquals(getFileContent(fp.fullPath(target_file)), 'Temp file')
+        os.unlink(source_file)
+
+    def testFileCopyHash(self):
+        FileProcess.storage = FileProcess.STORE_HASH
+        source_file = mkTempFile('Temp file')
+        fp = FileProcess()
+        target_file = fp.copyFile(source_file, short_dir = 'h', ext = '.txt')
+        os.utime(fp.fullPath(target_file), (0, 0))
+        self.assertEquals(fp.copyFile(source_file, short_dir = 'h', ext = '.txt'), target_file)
+        self.assert_(os.path.getmtime(fp.fullPath(target_file)) > 0)
+        self.assertEquals(getFileContent(fp.fullPath(target_file)), 'Temp file')
+        split_p = target_file.split(os.path.sep)
+        self.assertEquals(len(split_p), 2 + FileProcess.hash_levels)
+        self.assertEquals(split_p[0], 'h')
+        other_file = mkTempFile('Other file')
+        self.assertNotEquals(fp.copyFile(other_file, short_dir = 'h', ext = '.txt'), target_file)
+        os.unlink(source_file)
+        os.unlink(other_file)
+
     def testImageInfo(self):
         i = ImageInfo(fileInTestDir('img/test.jpg'))
         self.assertEquals(i.is_image(), True)
@@ -58,6 +112,25 @@ class TestFileImage(unittest.TestCase):
         self.assertEquals(bi.is_image(), False)
         os.unlink(bad_file)
 
+    def testImageInfoProbe(self):
+        for (pil_format, content_type) in [('PNG', ImageInfo.PNG), ('GIF', ImageInfo.GIF),\
+                ('JPEG', ImageInfo.JPEG)]:
+            file_path = mkTempFile()
+            PilImage.new('RGB', (31, 17)).save(file_path, pil_format)
+            i = ImageInfo(file_path)
+            self.assertEquals((i.content_type, i.width, i.height), (content_type, 31, 17))
+            hits = ImageInfo.probe_cache.hits
+            ImageInfo(file_path)
+            self.assertEquals(ImageInfo.probe_cache.hits, hits + 1)
+            PilImage.new('RGB', (64, 48)).save(file_path, pil_format)
+            os.utime(file_path, (0, 0))
+            i = ImageInfo(file_path)
+            self.assertEquals((i.width, i.height), (64, 48))
+            os.unlink(file_path)
+        i = ImageInfo(fileInTestDir('img/missing.jpg'))
+        self.assertEquals(i.is_image(), False)
+        self.assertRaises(AttributeError, setattr, i, 'unknown', 1)
+
     def testImageCopy(self):
         it = ImageTransform.create(ImageTransform.STD, 100, 100);
         fp = FileProcess()
@@ -75,6 +148,55 @@ class TestFileImage(unittest.TestCase):
         self.assertEquals(info.width, 418)
         self.assertEquals(info.height, 604) 
 
+    def testTransformTypes(self):
+        big_file = mkImageWithFrame(1600, 1200).file_path
+        expected = [
+            (ImageTransform.STD, (126, 94)),
+            (ImageTransform.CROP, (126, 126)),
+            (ImageTransform.PAD, (126, 126)),
+            (ImageTransform.WIDTH, (126, 94))
+        ]
+        for (transform_type, size) in expected:
+            it = ImageTransform.create(transform_type, 126, 126)
+            im = PilImage.open(big_file)
+            self.assertEquals(it.transformImage(im).size, size)
+            self.assert_(im.size[0] < 1600)
+        self.assertRaises(FileImageException, ImageTransform.create, 0)
+        os.unlink(big_file)
+
+    def testIngestImage(self):
+        it = ImageTransform.create(ImageTransform.STD, 100, 100);
+        fp = FileProcess()
+        (info, thumb_info) = fp.ingestImage(fileInTestDir('img/test.jpg'), transform = it, short_dir = 'i')
+        self.assertEquals(info.content_type, ImageInfo.JPEG)
+        self.assertEquals(info.width, 418)
+        self.assertEquals(info.height, 604)
+        self.assertEquals(thumb_info.content_type, ImageInfo.JPEG)
+        self.assert_(thumb_info.width <= 100)
+        self.assert_(thumb_info.height <= 100)
+        for i in [info, thumb_info]:
+            stored = fp.imageInfo(i.short_path)
+            self.assertEquals((stored.width, stored.height), (i.width, i.height))
+        bad_file = mkTempFile('Not image')
+        self.assertEquals(fp.ingestImage(bad_file, transform = it), (None, None))
+        os.unlink(bad_file)
+
+    def testIngestImages(self):
+        it = ImageTransform.create(ImageTransform.STD, 100, 100);
+        fp = FileProcess()
+        bad_file = mkTempFile('Not image')
+        good_file = fileInTestDir('img/test.jpg')
+        results = fp.ingestImages([good_file, bad_file, good_file], transform = it, processes = 2)
+        self.assertEquals([r.source_file for r in results], [good_file, bad_file, good_file])
+        self.assertEquals([bool(r) for r in results], [True, False, True])
+        self.assert_(results[1].error)
+        self.assertNotEquals(results[0].image_info.short_path, results[2].image_info.short_path)
+        for r in [results[0], results[2]]:
+            self.assert_(os.path.isfile(fp.fullPath(r.image_info.short_path)))
+            self.assert_(os.path.isfile(fp.fullPath(r.thumb_info.short_path)))
+            self.assertEquals(r.image_info.width, 418)
+        os.unlink(bad_file)
+
     def testAddImageToDb(self):
         it = ImageType(ImageType.TARGET_NONE)
         it.max_thumb_height = 50
@@ -107,13 +229,446 @@ class TestFileImage(unittest.TestCase):
 
         ret = img.uploadFromFile(fileInTestDir('img/test.jpg'))
         self.assert_(ret)
+        self.assert_(os.path.isfile(FileProcess.fullPath(old_thumb_path)))
+        session.commit()
         self.assert_(not os.path.isfile(FileProcess.fullPath(old_thumb_path)))
         self.assert_(not os.path.isfile(FileProcess.fullPath(old_image_path)))
 
+        old_image_path = img.image_path
+        ret = img.uploadFromFile(fileInTestDir('img/test.jpg'))
+        self.assert_(ret)
+        session.rollback()
+        self.assertEquals(img.image_path, old_image_path)
+        self.assert_(os.path.isfile(FileProcess.fullPath(old_image_path)))
+
+        FileProcess.startFileRemover()
+        ret = img.uploadFromFile(fileInTestDir('img/test.jpg'))
+        self.assert_(ret)
+        session.commit()
+        FileProcess.file_remover.wait()
+        FileProcess.file_remover = None
+        self.assert_(not os.path.isfile(FileProcess.fullPath(old_image_path)))
+
+        session.delete(img)
+        session.delete(it)
+        session.commit()
+
+    def testClosedSessionFiles(self):
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        img = Image(it)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.add(img)
+        session.commit()
+        (image_path, image_id) = (img.image_path, img.image_id)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        new_image_path = img.image_path
+        session.flush()
+        session.close()
+        session.add(Place('Closed session place'))
+        session.commit()
+        self.assert_(os.path.isfile(FileProcess.fullPath(image_path)))
+        self.assert_(not os.path.isfile(FileProcess.fullPath(new_image_path)))
+        img = session.query(Image).filter(Image.image_id == image_id).one()
+        self.assertEquals(img.image_path, image_path)
+        session.query(Place).filter(Place.title_name == 'Closed session place').delete()
+        session.delete(img)
+        session.delete(img.image_type)
+        session.commit()
+
+    def testSharedHashFiles(self):
+        FileProcess.storage = FileProcess.STORE_HASH
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        session.add(it)
+        images = [Image(it), Image(it)]
+        for img in images:
+            self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+            session.add(img)
+        session.commit()
+        (first, second) = images
+        self.assertEquals(first.image_path, second.image_path)
+        self.assertEquals(first.thumb_path, second.thumb_path)
+        session.delete(first)
+        session.commit()
+        self.assert_(os.path.isfile(FileProcess.fullPath(second.image_path)))
+        self.assert_(os.path.isfile(FileProcess.fullPath(second.thumb_path)))
+        image_path = second.image_path
+
+        # one session drops the last reference while another reuses the file
+        other_session = Session.session_factory()
+        other = Image(other_session.merge(it))
+        self.assert_(other.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.delete(second)
+        session.commit()
+        other_session.add(other)
+        other_session.commit()
+        self.assertEquals(other.image_path, image_path)
+        self.assert_(os.path.isfile(FileProcess.fullPath(image_path)))
+        other_session.delete(other)
+        other_session.commit()
+        other_session.close()
+
+        session.delete(it)
+        session.commit()
+        self.assertEquals(session.query(FileRef).filter(FileRef.file_path == image_path).count(), 0)
+        self.assert_(os.path.isfile(FileProcess.fullPath(image_path)))
+        FileGC(session, grace_seconds = 0, delete = True).run()
+        self.assert_(not os.path.isfile(FileProcess.fullPath(image_path)))
+
+    def testRebalanceFiles(self):
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.base_dir = 'r'
+        it.transform_type = ImageTransform.STD
+        img = Image(it)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.add(img)
+        session.commit()
+        old_paths = [img.image_path, img.thumb_path]
+        for old_path in old_paths:
+            os.utime(FileProcess.fullPath(old_path), (0, 0))
+        updates = []
+        def count_update(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE images'):
+                updates.append(statement)
+        alchemy_event.listen(engine, 'before_cursor_execute', count_update)
+        try:
+            self.assertEquals(rebalanceFiles(session, 1, 2), 2)
+        finally:
+            alchemy_event.remove(engine, 'before_cursor_execute', count_update)
+        # one primary key update per column and batch
+        self.assertEquals(len(updates), 2)
+        self.assert_([u for u in updates if 'WHERE images.image_id = ?' in u])
+        session.expire_all()
+        for (old_path, new_path) in zip(old_paths, [img.image_path, img.thumb_path]):
+            self.assert_(os.path.getmtime(FileProcess.fullPath(new_path)) > 0)
+            self.assertEquals(len(new_path.split(os.path.sep)), len(old_path.split(os.path.sep)) + 1)
+            self.assertEquals(os.path.basename(new_path), os.path.basename(old_path))
+            self.assert_(os.path.isfile(FileProcess.fullPath(new_path)))
+            self.assert_(not os.path.isfile(FileProcess.fullPath(old_path)))
+        session.delete(img)
+        session.delete(it)
+        session.commit()
+
+    def testPackStore(self):
+        store = PackStore(os.path.join(self.temp_dir, 'packs'), max_pack_bytes = 100)
+        refs = [store.put(('blob %d ' % v).encode('ascii') * 10) for v in range(4)]
+        self.assertEquals(bytes(store.read(refs[2])), b'blob 2 ' * 10)
+        self.assertEquals(store.stats()['packs'], 4)
+        self.assert_(store.remove(refs[1]))
+        self.assert_(not store.remove(refs[1]))
+        self.assertRaises(PackStoreException, store.read, refs[1])
+        self.assertRaises(PackStoreException, store.read, 'img/1.jpg')
+
+        reopened = PackStore(store.pack_dir, max_pack_bytes = 100)
+        self.assertEquals(bytes(reopened.read(refs[3])), b'blob 3 ' * 10)
+        self.assert_(not reopened.contains(refs[1]))
+        self.assertEquals(reopened.stats()['dead_bytes'], 70)
+        self.assertEquals(reopened.compact(), 70)
+        stats = reopened.stats()
+        self.assertEquals((stats['blobs'], stats['dead_bytes'], stats['live_bytes']), (3, 0, 210))
+        for (v, ref) in enumerate(refs):
+            if v != 1:
+                self.assertEquals(bytes(store.read(ref)), ('blob %d ' % v).encode('ascii') * 10)
+
+    def testPackStoreShared(self):
+        pack_dir = os.path.join(self.temp_dir, 'packs')
+        (a, b) = (PackStore(pack_dir, max_pack_bytes = 1000), PackStore(pack_dir, max_pack_bytes = 1000))
+        refs = [b.put(('blob %d ' % v).encode('ascii') * 10) for v in range(5)]
+        for ref in refs[:4]:
+            self.assert_(b.remove(ref))
+        self.assertEquals(a.stats()['dead_bytes'], 280)
+        self.assertEquals(a.compact(), 280)
+        # b still knows the old pack number, a new blob must not land in a pack a just removed
+        new_ref = b.put(b'new blob')
+        self.assertEquals(bytes(b.read(refs[4])), b'blob 4 ' * 10)
+        self.assertEquals(bytes(b.read(new_ref)), b'new blob')
+        self.assertEquals(bytes(a.read(new_ref)), b'new blob')
+        self.assertEquals(b.stats()['dead_bytes'], 0)
+
+        pack = a.packs[a.index[PackStore.refKey(new_ref)][0]]
+        with open(pack.data_path, 'r+b') as f:
+            f.truncate(10)
+        self.assertRaises(PackStoreException, PackStore(pack_dir).read, new_ref)
+
+    def testPackThumbs(self):
+        FileProcess.pack_thumbs = True
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        img = Image(it)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.add(img)
+        session.commit()
+        self.assert_(img.thumb_path.startswith('pack:'))
+        thumb = PilImage.open(BytesIO(FileProcess.readFile(img.thumb_path)))
+        self.assertEquals(thumb.size, (img.thumb_width, img.thumb_height))
+        old_thumb_path = img.thumb_path
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.commit()
+        self.assert_(not FileProcess.packStore().contains(old_thumb_path))
+        self.assert_(FileProcess.packStore().contains(img.thumb_path))
+
+        FileProcess.pack_thumbs = False
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.commit()
+        file_thumb_path = img.thumb_path
+        updates = []
+        def count_update(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE images'):
+                updates.append(statement)
+        alchemy_event.listen(engine, 'before_cursor_execute', count_update)
+        try:
+            self.assertEquals(migrateThumbs(session), 1)
+        finally:
+            alchemy_event.remove(engine, 'before_cursor_execute', count_update)
+        self.assertEquals(len(updates), 1)
+        self.assert_('WHERE images.image_id = ?' in updates[0])
+        session.expire_all()
+        self.assert_(img.thumb_path.startswith('pack:'))
+        self.assert_(not os.path.isfile(FileProcess.fullPath(file_thumb_path)))
+        session.delete(img)
+        session.delete(it)
+        session.commit()
+
+    def testMetrics(self):
+        metrics.registry.reset()
+        fp = FileProcess()
+        transform = ImageTransform.create(ImageTransform.STD, 100, 100)
+        info = fp.copyImage(fileInTestDir('img/test.jpg'), transform = transform)
+        self.assert_(info.is_image())
+        FileProcess.removeFiles([info.short_path])
+        session.execute(text('SELECT 1'))
+        session.rollback()
+        snap = metrics.export()
+        self.assertEquals(snap['histograms']['image_copy_seconds']['count'], 1)
+        self.assertEquals(snap['histograms']['file_copy_seconds']['count'], 1)
+        self.assert_(snap['histograms']['db_statement_seconds']['count'] >= 1)
+        self.assertEquals(snap['counters']['files_removed'], 1)
+        self.assert_(snap['counters']['file_bytes_written'] > 0)
+        self.assertEquals(snap['counters']['file_bytes_written'], snap['counters']['file_bytes_removed'])
+
+        metrics.registry.slow_query_time = 0
+        session.execute(text('SELECT 2'))
+        session.rollback()
+        metrics.registry.slow_query_time = 0.1
+        self.assert_('SELECT 2' in [q['statement'] for q in metrics.export()['slow_queries']])
+        text_export = metrics.export('prometheus')
+        self.assert_('# TYPE board_image_copy_seconds histogram' in text_export)
+        self.assert_('board_image_copy_seconds_bucket{le="+Inf"} 1' in text_export)
+        self.assert_('board_files_removed_total 1' in text_export)
+        self.assertEquals(json.loads(metrics.export('json'))['counters']['files_removed'], 1)
+
+        (info, thumb_info) = fp.ingestImage(fileInTestDir('img/test.jpg'), transform = transform)
+        FileProcess.removeFiles([info.short_path, thumb_info.short_path])
+        self.assertRaises(Exception, session.execute, text('SELECT * FROM missing_table'))
+        session.rollback()
+        snap = metrics.export()
+        self.assertEquals(snap['histograms']['image_ingest_seconds']['count'], 1)
+        self.assertEquals(snap['histograms']['thumb_encode_seconds']['count'], 2)
+        self.assertEquals(snap['counters']['db_statement_errors'], 1)
+
+    def testEncodingProfile(self):
+        source_file = fileInTestDir('img/test.jpg')
+        im = PilImage.open(source_file)
+        default_size = len(EncodingProfile().encode(im, ImageInfo.JPEG))
+        budget = default_size * 2 // 3
+        size = len(EncodingProfile(ImageInfo.JPEG, quality = 90, max_bytes = budget).encode(im, ImageInfo.JPEG))
+        self.assert_(size <= budget)
+        self.assert_(size > len(EncodingProfile(quality = 30).encode(im, ImageInfo.JPEG)))
+        progressive = EncodingProfile(quality = 75, progressive = True, optimize = True)
+        self.assert_(PilImage.open(BytesIO(progressive.encode(im, ImageInfo.JPEG))).info.get('progressive'))
+
+        for mode in ('RGB', 'RGBA', 'P'):
+            webp_file = mkTempFile()
+            with open(webp_file, 'wb') as f:
+                f.write(EncodingProfile(ImageInfo.WEBP, quality = 60).encode(im.convert(mode), ImageInfo.WEBP))
+            info = ImageInfo(webp_file)
+            self.assertEquals((info.content_type, info.width, info.height), (ImageInfo.WEBP, 418, 604))
+            self.assertEquals(info.file_ext, '.webp')
+            os.unlink(webp_file)
+
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        img = Image(it)
+        self.assert_(img.uploadFromFile(source_file))
+        session.add(img)
+        session.commit()
+        old_thumb_path = img.thumb_path
+        self.assert_(old_thumb_path.endswith('.jpg'))
+        it.encoding_type = ImageInfo.WEBP
+        it.encoding_quality = 70
+        it.encoding_strip = True
+        self.assertEquals(reencodeThumbs(session, it), 1)
+        self.assert_(img.thumb_path.endswith('.webp'))
+        info = ImageInfo(FileProcess.fullPath(img.thumb_path))
+        self.assertEquals((info.content_type, info.width, info.height),\
+                (ImageInfo.WEBP, img.thumb_width, img.thumb_height))
+        self.assert_(not os.path.isfile(FileProcess.fullPath(old_thumb_path)))
+        self.assertEquals(img.content_type, ImageInfo.JPEG)
+        session.delete(img)
+        session.delete(it)
+        session.commit()
+
+    def testSprites(self):
+        (positions, width, height) = packTiles({1: (30, 20), 2: (30, 10), 3: (50, 20)}, max_width = 80)
+        self.assertEquals(positions, {3: (0, 0), 1: (50, 0), 2: (0, 20)})
+        self.assertEquals((width, height), (80, 30))
+
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 40
+        it.max_thumb_width = 40
+        it.transform_type = ImageTransform.STD
+        images = [Image(it) for v in range(3)]
+        for img in images:
+            self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.add_all(images)
+        session.commit()
+        sprite = buildSprite(session, 'test-sprite', images)
+        session.commit()
+        manifest = sprite.manifest(session)
+        self.assertEquals(sorted(manifest['images'].keys()), sorted([img.image_id for img in images]))
+        sheet = PilImage.open(FileProcess.fullPath(sprite.sprite_path))
+        self.assertEquals(sheet.size, (manifest['width'], manifest['height']))
+        for img in images:
+            tile = manifest['images'][img.image_id]
+            self.assertEquals((tile['width'], tile['height']), (img.thumb_width, img.thumb_height))
+        sprite_path = sprite.sprite_path
+        self.assertEquals(buildSprite(session, 'test-sprite', images).sprite_path, sprite_path)
+
+        self.assert_(images[1].uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.commit()
+        self.assertEquals(sprite.stale, True)
+        self.assertEquals(rebuildStale(session), 1)
+        self.assertNotEquals(sprite.sprite_path, sprite_path)
+        self.assert_(not os.path.isfile(FileProcess.fullPath(sprite_path)))
+        self.assertEquals(sprite.manifest(session)['images'], manifest['images'])
+
+        session.delete(images[0])
+        session.commit()
+        self.assertEquals(sprite.stale, True)
+        self.assertEquals(rebuildStale(session), 1)
+        self.assertEquals(sorted(sprite.manifest(session)['images'].keys()),\
+                sorted([img.image_id for img in images[1:]]))
+        self.assertEquals(sprite.stale, False)
+        session.execute(sprite_images.delete())
+        session.delete(sprite)
+        for img in images[1:]:
+            session.delete(img)
+        session.delete(it)
+        session.commit()
+
+    def testLazyImports(self):
+        code = "import model, sys; model.startup(); "\
+                "print(' '.join([m for m in ('PIL', 'Image', 'ImageDraw', 'multiprocessing') if m in sys.modules]))"
+        out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code],\
+                cwd = os.path.dirname(os.path.abspath(__file__)))
+        self.assertEquals(out.strip(), b'')
+        self.assert_(mkImageWithFrame(10, 10).is_image())
+
+    def testFileGC(self):
+        refs = PathSet(chunk_size = 2)
+        for file_path in ['img/1/2.jpg', 'img/3/4.jpg', 'img/1/2.jpg', 'img/5/6.jpg']:
+            refs.add(file_path)
+        refs.freeze()
+        self.assertEquals(len(refs), 3)
+        self.assert_('img/3/4.jpg' in refs)
+        self.assert_(not 'img/3/5.jpg' in refs)
+
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        img = Image(it)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        session.add(img)
+        session.commit()
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        (rolled_back_image, rolled_back_thumb) = (img.image_path, img.thumb_path)
+        session.rollback()
+        self.assert_(not os.path.isfile(FileProcess.fullPath(rolled_back_image)))
+        self.assert_(not os.path.isfile(FileProcess.fullPath(rolled_back_thumb)))
+
+        fp = FileProcess()
+        orphan = fp.copyFile(mkTempFile('orphan'), short_dir = 'img', ext = '.jpg')
+        recent = fp.copyFile(mkTempFile('recent'), short_dir = 'img', ext = '.jpg')
+        day_ago = os.path.getmtime(FileProcess.fullPath(orphan)) - 2 * 86400
+        os.utime(FileProcess.fullPath(orphan), (day_ago, day_ago))
+        reported = []
+        stats = FileGC(session, workers = 3, report = lambda p, size: reported.append(p)).run()
+        self.assertEquals(reported, [orphan])
+        self.assertEquals((stats['orphans'], stats['recent'], stats['deleted']), (1, 1, 0))
+        stats = FileGC(session, delete = True).run()
+        self.assertRaises(FileImageException, FileGC, session, roots = [''])
+        FileProcess.img_subdir = None
+        self.assertRaises(FileImageException, FileGC, session)
+        FileProcess.img_subdir = 'img'
+        self.assertEquals(stats['deleted'], 1)
+        self.assert_(not os.path.isfile(FileProcess.fullPath(orphan)))
+        for file_path in (recent, img.image_path, img.thumb_path):
+            self.assert_(os.path.isfile(FileProcess.fullPath(file_path)))
         session.delete(img)
         session.delete(it)
         session.commit()
 
+    def testUploadFromFiles(self):
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        bad_file = mkTempFile('Not image')
+        uploaded = Image.uploadFromFiles(it, [fileInTestDir('img/test.jpg'), bad_file], processes = 1)
+        self.assertEquals(len(uploaded), 2)
+        (img, result) = uploaded[0]
+        self.assertEquals(img.image_width, 418)
+        self.assert_(img.thumb_width <= 150)
+        self.assertEquals(uploaded[1][0], None)
+        self.assert_(not uploaded[1][1])
+        os.unlink(bad_file)
+
+    def testRenditions(self):
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 50
+        it.transform_type = ImageTransform.STD
+        it.renditions.append(ImageRendition('card', 200, 200))
+        it.renditions.append(ImageRendition('list', 80, 80))
+        img = Image(it)
+        self.assert_(img.uploadFromFile(fileInTestDir('img/test.jpg')))
+        cache = RenditionCache(max_bytes = 1)
+        card_path = img.renditionPath('card', cache)
+        self.assertEquals(img.renditionPath('card', cache), card_path)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        info = FileProcess.imageInfo(card_path)
+        self.assertEquals(info.height, 200)
+        self.assert_(info.width <= 200)
+        list_path = img.renditionPath('list', cache)
+        self.assertEquals(cache.evictions, 1)
+        self.assert_(not os.path.isfile(FileProcess.fullPath(card_path)))
+        self.assert_(os.path.isfile(FileProcess.fullPath(list_path)))
+        self.assertRaises(ModelExteption, img.renditionPath, 'missing', cache)
+        other_cache = RenditionCache(max_bytes = 1)
+        self.assertEquals(img.renditionPath('card', other_cache), card_path)
+        self.assert_(not os.path.isfile(FileProcess.fullPath(list_path)))
+        self.assertEquals(img.renditionPath('list', cache), list_path)
+        self.assertEquals((cache.hits, cache.misses), (1, 3))
+        self.assert_(os.path.isfile(FileProcess.fullPath(list_path)))
+
+        it.encoding_type = ImageInfo.PNG
+        png_path = img.renditionPath('list', cache)
+        self.assertNotEquals(png_path, list_path)
+        self.assert_(png_path.endswith('.png'))
+        self.assertEquals(FileProcess.imageInfo(png_path).content_type, ImageInfo.PNG)
+
     def testDefThumb(self):
         it = ImageType(ImageType.TARGET_NONE)
         it.max_thumb_height = 345
@@ -133,6 +688,47 @@ class TestFileImage(unittest.TestCase):
         session.delete(it)
         session.commit()
 
+    def testAsyncUpload(self):
+        it = ImageType(ImageType.TARGET_NONE)
+        it.max_thumb_height = 50
+        it.max_thumb_width = 150
+        it.transform_type = ImageTransform.STD
+        bad_file = mkTempFile('Not image')
+        uploader = AsyncUploader(max_in_flight = 2)
+        async def upload():
+            images = await uploader.uploadFromFiles(it, [fileInTestDir('img/test.jpg')] * 3 + [bad_file])
+            ret = await uploader.mkDefThumb(it)
+            return (images, ret)
+        (images, ret) = asyncio.run(upload())
+        self.assertEquals(ret, True)
+        self.assert_(os.path.isfile(FileProcess.fullPath(it.def_thumb_path)))
+        self.assertEquals(images[3], None)
+        self.assertEquals(len(set([img.image_path for img in images[:3]])), 3)
+        for img in images[:3]:
+            self.assertEquals((img.image_width, img.image_height), (418, 604))
+            self.assert_(img.thumb_width <= 150)
+            self.assert_(os.path.isfile(FileProcess.fullPath(img.thumb_path)))
+        os.unlink(bad_file)
+        # the same uploader on a second loop
+        images = asyncio.run(uploader.uploadFromFiles(it, [fileInTestDir('img/test.jpg')] * 3))
+        self.assertEquals(len([img for img in images if not img is None]), 3)
+
+        other_dir = os.path.join(self.temp_dir, 'other')
+        os.mkdir(other_dir)
+        settings = {'base_dir': other_dir, 'img_subdir': 'other_img'}
+        job = (settings, fileInTestDir('img/test.jpg'), it.thumb_transform_image, None, None)
+        result = ingestWorker(job)
+        self.assertEquals((FileProcess.base_dir, FileProcess.img_subdir), (self.temp_dir, 'img'))
+        self.assert_(result.image_info.short_path.startswith('other_img'))
+        self.assert_(os.path.isfile(os.path.join(other_dir, result.thumb_info.short_path)))
+        # a spawned worker only knows the settings in its job
+        settings.update({'storage': FileProcess.STORE_HASH, 'pack_thumbs': True})
+        result = ingestWorker(job)
+        self.assertEquals(FileProcess.storage, FileProcess.STORE_RANDOM)
+        self.assertEquals(len(os.path.splitext(os.path.basename(result.image_info.short_path))[0]), 40)
+        self.assert_(result.thumb_info.short_path.startswith('pack:'))
+        self.assert_(FileProcess.packStore(os.path.join(other_dir, 'packs')).contains(result.thumb_info.short_path))
+
 
 class TestEvent(unittest.TestCase):
     def setUp(self):
@@ -186,10 +782,23 @@ class TestEvent(unittest.TestCase):
         self.assertEquals(e.source_type, EventSourceType.EMPTY)
         self.assertEquals(e.event_type.name, 'first')
 
-        all_date_empty = session.query(Event).filter(Event.time_start == date(1971, 1, 1)).all() 
+        all_date_empty = session.query(Event).filter(onDay(Event.time_start, date(1971, 1, 1))).all() 
         self.assertEquals(len(all_date_empty), 0)
-        all_date_fine = session.query(Event).filter(Event.time_start == date(1970, 1, 1)).all() 
+        all_date_fine = session.query(Event).filter(onDay(Event.time_start, date(1970, 1, 1))).all() 
         self.assertEquals(len(all_date_fine), 1)
+        all_after = session.query(Event).filter(dateRange(Event.time_start, date(1969, 12, 31))).all()
+        self.assertEquals(len(all_after), 1)
+        all_until = session.query(Event).filter(dateRange(Event.time_start, date_to = date(1969, 12, 31))).all()
+        self.assertEquals(len(all_until), 0)
+        all_week = session.query(Event).\
+                filter(dateRange(Event.time_start, date(1969, 12, 29), date(1970, 1, 4))).all()
+        self.assertEquals(len(all_week), 1)
+        all_before = session.query(Event).\
+                filter(dateRange(Event.time_start, date(1969, 12, 29), datetime(1970, 1, 1))).all()
+        self.assertEquals(len(all_before), 0)
+        sql = str(onDay(Event.time_start, date(1970, 1, 1)))
+        self.assertEquals(sql, 'events.time_start >= :time_start_1 AND events.time_start < :time_start_2')
+        self.assertEquals(str(dateRange(Event.time_start, date(1970, 1, 1))), 'events.time_start >= :time_start_1')
         session.delete(e)
         session.commit()
 
@@ -241,6 +850,249 @@ class TestEvent(unittest.TestCase):
         self.assertEquals(len(e.event_status_list), 2)
         self.assertEquals(e.last_status, EventStatus.LIVE_BE_HERE)
 
+    def testListing(self):
+        session.query(Event).delete()
+        session.commit()
+        place = Place('Listing place')
+        other_place = Place('Other place')
+        for day in range(1, 6):
+            e = Event(self.et, 'Listing %d' % day)
+            e.time_start = datetime(1980, 1, day, 20, 0)
+            e.place = place if day % 2 else other_place
+            e.persons.append(Person('Listing person %d' % day, Person.MUSICIAN))
+            session.add(e)
+        session.commit()
+        support = Person('Listing support', Person.MUSICIAN)
+        e.persons.insert(0, support)
+        session.commit()
+        session.expire_all()
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        alchemy_event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            events = Event.listing(session, event_type = 'first',\
+                    date_from = datetime(1980, 1, 2), date_to = datetime(1980, 1, 5))
+            titles = [(e.title, e.place.title_name, e.event_type.name, [p.name for p in e.persons],\
+                    e.links, e.main_image) for e in events]
+        finally:
+            alchemy_event.remove(engine, 'before_cursor_execute', count_statement)
+        self.assertEquals([t[0] for t in titles], ['Listing 2', 'Listing 3', 'Listing 4'])
+        self.assertEquals(titles[0][3], ['Listing person 2'])
+        self.assertEquals(len(statements), 3)
+
+        events = Event.listing(session, event_type = self.et, place = place)
+        self.assertEquals([e.title for e in events], ['Listing 1', 'Listing 3', 'Listing 5'])
+        self.assertEquals([p.name for p in events[2].persons], ['Listing support', 'Listing person 5'])
+        orders = session.execute(event_persons.select().where(event_persons.c.event_id == events[2].event_id)).fetchall()
+        self.assertEquals(sorted([r.order for r in orders]), [0, 1])
+        self.assertEquals(len(Event.listing(session, event_type = 'live')), 0)
+
+        for e in session.query(Event):
+            e.persons = []
+            session.delete(e)
+        session.commit()
+
+    def testLookupCache(self):
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        self.assertEquals(EventType.findByName(session, 'first').event_type_id, self.et.event_type_id)
+        alchemy_event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            other_session = Session.session_factory()
+            et = EventType.findByName(other_session, 'first')
+            self.assertEquals(et.title, 'First')
+            self.assert_(EventType.find(other_session, et.event_type_id) is et)
+            self.assertEquals(statements, [])
+            self.assert_(not et is self.et)
+            e = Event(et, 'Cached type')
+            other_session.add(e)
+            other_session.flush()
+            other_session.rollback()
+            other_session.close()
+        finally:
+            alchemy_event.remove(engine, 'before_cursor_execute', count_statement)
+        self.et.title = 'First renamed'
+        session.commit()
+        other_session = Session.session_factory()
+        self.assertEquals(EventType.findByName(other_session, 'first').title, 'First renamed')
+        other_session.close()
+
+        session.add(EventType('fresh', 'Fresh'))
+        session.flush()
+        self.assertEquals(EventType.findByName(session, 'fresh').title, 'Fresh')
+        other_session = Session.session_factory()
+        self.assertRaises(ModelExteption, EventType.findByName, other_session, 'fresh')
+        session.rollback()
+        self.assertRaises(ModelExteption, EventType.findByName, other_session, 'fresh')
+        other_session.close()
+        self.assertRaises(ModelExteption, EventType.findByName, session, 'missing')
+
+        ld = LinkDomain('cache.example.com')
+        session.add(ld)
+        session.commit()
+        self.assert_(LinkDomain.findByDomain(session, 'cache.example.com') is ld)
+        session.delete(ld)
+        session.commit()
+        self.assertEquals(LinkDomain.findByDomain(session, 'cache.example.com'), None)
+
+    def testStatusCounts(self):
+        e = Event(self.et, 'Counted event')
+        other = Event(self.et, 'Other counted event')
+        session.add_all([e, other])
+        session.commit()
+        e.addEventStatus(EventStatus(EventStatus.LIVE_WANT))
+        e.addEventStatus(EventStatus(EventStatus.LIVE_WANT))
+        e.addEventStatus(EventStatus(EventStatus.LIVE_BE_HERE))
+        session.commit()
+        self.assertEquals(e.statusCount(EventStatus.LIVE_WANT), 2)
+        self.assertEquals(e.statusCount(EventStatus.LIVE_BE_HERE), 1)
+        self.assertEquals(other.statusCount(EventStatus.LIVE_WANT), 0)
+
+        EventStatus.bulkAdd(session, [(e.event_id, EventStatus.LIVE_BE_HERE),\
+                (other.event_id, EventStatus.LIVE_BE_HERE), (other.event_id, EventStatus.LIVE_WANT, 'Me')])
+        session.commit()
+        counts = EventStatusCount.forEvents(session, [e.event_id, other.event_id])
+        self.assertEquals(counts[e.event_id], {EventStatus.LIVE_WANT: 2, EventStatus.LIVE_BE_HERE: 2})
+        self.assertEquals(counts[other.event_id], {EventStatus.LIVE_WANT: 1, EventStatus.LIVE_BE_HERE: 1})
+        self.assertEquals(other.last_status, EventStatus.LIVE_WANT)
+
+        status = e.event_status_list[0]
+        status.status = EventStatus.LIVE_BE_HERE
+        session.commit()
+        session.delete(e.event_status_list[1])
+        session.commit()
+        session.expire_all()
+        self.assertEquals(e.statusCount(EventStatus.LIVE_WANT), 0)
+        self.assertEquals(e.statusCount(EventStatus.LIVE_BE_HERE), 3)
+
+        session.query(EventStatusCount).delete()
+        session.commit()
+        EventStatusCount.rebuild(session)
+        counts = EventStatusCount.forEvents(session, [e.event_id, other.event_id])
+        self.assertEquals(counts[e.event_id], {EventStatus.LIVE_BE_HERE: 3})
+        self.assertEquals(counts[other.event_id], {EventStatus.LIVE_WANT: 1, EventStatus.LIVE_BE_HERE: 1})
+
+        raced = []
+        def racingUpdate(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE event_status_counts') and not raced:
+                raced.append(statement)
+                # a second writer inserts between our update and insert
+                conn.connection.cursor().execute('INSERT INTO event_status_counts VALUES (?, ?, 5)',\
+                        (other.event_id, EventStatus.EMPTY))
+        alchemy_event.listen(engine, 'after_cursor_execute', racingUpdate)
+        try:
+            EventStatusCount.adjust(session.connection(), other.event_id, EventStatus.EMPTY, 1)
+        finally:
+            alchemy_event.remove(engine, 'after_cursor_execute', racingUpdate)
+        session.commit()
+        self.assertEquals(EventStatusCount.forEvents(session, [other.event_id])[other.event_id][EventStatus.EMPTY], 6)
+
+        fk_engine = createEngine(engine.url.render_as_string(hide_password = False))
+        alchemy_event.listen(fk_engine, 'connect',\
+                lambda dbapi_conn, record: dbapi_conn.execute('PRAGMA foreign_keys = ON'))
+        fk_session = Session.session_factory(bind = fk_engine)
+        event_ids = [e.event_id, other.event_id]
+        for ev in fk_session.query(Event).filter(Event.event_id.in_(event_ids)):
+            fk_session.delete(ev)
+        fk_session.commit()
+        fk_session.close()
+        fk_engine.dispose()
+        session.expire_all()
+        self.assertEquals(EventStatusCount.forEvents(session, event_ids), dict([(v, {}) for v in event_ids]))
+        session.query(EventStatus).delete()
+        session.commit()
+
+    def testStream(self):
+        session.query(Event).delete()
+        session.commit()
+        for n in range(7):
+            e = Event(self.et, 'Stream %d' % n)
+            e.time_start = datetime(1990, 1, 1 + n // 2, 20, 0)
+            session.add(e)
+        session.add(Event(self.et, 'No time'))
+        session.commit()
+
+        stream = Event.stream(session, chunk_size = 3)
+        titles = []
+        for e in stream:
+            titles.append(e.title)
+            if len(titles) == 4:
+                cursor = stream.cursor
+        self.assertEquals(titles, ['Stream %d' % n for n in range(7)])
+        rest = [r['title'] for r in Event.stream(session, chunk_size = 2, cursor = cursor, as_dict = True)]
+        self.assertEquals(rest, ['Stream 4', 'Stream 5', 'Stream 6'])
+        rows = list(Event.stream(session, rows = True,\
+                filters = [onDay(Event.time_start, date(1990, 1, 2))]))
+        self.assertEquals([r.title for r in rows], ['Stream 2', 'Stream 3'])
+        self.assertRaises(ModelExteption, list, Event.stream(session, cursor = 'bad'))
+
+        session.query(Event).delete()
+        session.commit()
+
+    def testLinkDomains(self):
+        urls = ['http://www.vk.com/event1', 'https://m.vk.com/event2', 'http://LAST.fm:80/event/3',\
+                'http://news.example.co.uk/a', 'not a url://', '']
+        e = Event(self.et, 'Linked event')
+        links = e.addLinks(session, urls[0:4])
+        self.assertEquals([l.url for l in e.links], urls[0:4])
+        session.add(e)
+        session.commit()
+        self.assertEquals([l.link_domain.domain for l in e.links],\
+                ['vk.com', 'vk.com', 'last.fm', 'example.co.uk'])
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        LinkDomain.resolveUrls(session, urls)
+        alchemy_event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            domain_ids = LinkDomain.resolveUrls(session, urls)
+        finally:
+            alchemy_event.remove(engine, 'before_cursor_execute', count_statement)
+        self.assertEquals(statements, [])
+        self.assertEquals(domain_ids[urls[0]], domain_ids[urls[1]])
+        self.assert_(not urls[5] in domain_ids)
+
+        hosts = ['http://10.0.0.1/a', 'http://localhost:8080/b', 'http://[::1]/c']
+        vk_domain_id = domain_ids[urls[0]]
+        domain_ids = LinkDomain.resolveUrls(session, hosts)
+        self.assertEquals(len(set(domain_ids.values())), 3)
+        # other sessions must not get ids that may still be rolled back
+        self.assert_(not '10.0.0.1' in (link_domain_index.domains or {}))
+        other_session = Session.session_factory()
+        self.assertEquals(LinkDomain.resolveUrls(other_session, urls[0:1]), {urls[0]: vk_domain_id})
+        other_session.rollback()
+        self.assert_(not '10.0.0.1' in (link_domain_index.domains or {}))
+        session.rollback()
+        domain_ids = LinkDomain.resolveUrls(session, hosts)
+        session.commit()
+        self.assertEquals(sorted([d.domain for d in session.query(LinkDomain).\
+                filter(LinkDomain.domain_id.in_(list(domain_ids.values())))]), ['10.0.0.1', '::1', 'localhost'])
+        self.assertEquals(LinkDomain.resolveUrls(other_session, hosts), domain_ids)
+
+        # a domain another writer inserted after the index was loaded
+        self.assert_(not link_domain_index.domains is None)
+        other_session.execute(LinkDomain.__table__.insert().values(domain = 'race.example'))
+        other_session.commit()
+        race_urls = ['http://race.example/a', 'http://fresh.example/b']
+        domain_ids = LinkDomain.resolveUrls(session, race_urls)
+        session.commit()
+        self.assertEquals(sorted([d.domain for d in session.query(LinkDomain).\
+                filter(LinkDomain.domain_id.in_(list(domain_ids.values())))]), ['fresh.example', 'race.example'])
+        other_session.close()
+        session.query(LinkDomain).filter(LinkDomain.domain.in_(['race.example', 'fresh.example'])).\
+                delete(synchronize_session=False)
+
+        for l in e.links:
+            session.delete(l)
+        session.delete(e)
+        session.commit()
+        session.query(LinkDomain).delete()
+        session.commit()
+
     def testThird(self):
         e = Event(self.et)
         e.title = 'First event'
@@ -255,5 +1107,19 @@ class TestEvent(unittest.TestCase):
         session.delete(e) 
         session.commit()
 
+class TestConn(unittest.TestCase):
+    def testScopedSession(self):
+        sessions = []
+        t = Thread(target=lambda: sessions.append(Session()))
+        t.start()
+        t.join()
+        self.assert_(sessions[0] is not Session())
+        self.assert_(Session() is Session())
+
+    def testCreateEngine(self):
+        e = createEngine('sqlite://')
+        self.assertEquals(e.echo, False)
+        self.assertEquals(e.connect().execute(text('select 1')).scalar(), 1)
+
 if __name__ == '__main__':
     unittest.main()
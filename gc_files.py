@@ -0,0 +1,201 @@
+import sys
+import time
+import hashlib
+import heapq
+from os import path, scandir, unlink
+from array import array
+from bisect import bisect_left
+from threading import Thread, Lock
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from sqlalchemy import select
+
+from file_image import FileProcess, RenditionCache, FileImageException
+from pack_store import isPackRef
+from model import file_columns
+
+def pathHash(file_path):
+    digest = hashlib.blake2b(path.normpath(file_path).encode('utf-8'), digest_size = 8).digest()
+    return int.from_bytes(digest, 'little')
+
+class PathSet:
+    # 8 bytes per path in sorted arrays, a hash collision only ever keeps a file
+    def __init__(self, chunk_size = 1000000):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.pending = array('Q')
+        self.hashes = None
+
+    def add(self, file_path):
+        self.pending.append(pathHash(file_path))
+        if len(self.pending) >= self.chunk_size:
+            self.flushPending()
+
+    def flushPending(self):
+        if self.pending:
+            self.chunks.append(array('Q', sorted(self.pending)))
+            self.pending = array('Q')
+
+    def freeze(self):
+        self.flushPending()
+        hashes = array('Q')
+        last = None
+        for v in heapq.merge(*self.chunks):
+            if v != last:
+                hashes.append(v)
+                last = v
+        self.chunks = []
+        self.hashes = hashes
+        return self
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, file_path):
+        v = pathHash(file_path)
+        i = bisect_left(self.hashes, v)
+        return i < len(self.hashes) and self.hashes[i] == v
+
+def referencedPaths(session, batch_size = 10000):
+    for (cls, keys) in file_columns.items():
+        table = cls.__table__
+        pk = list(table.primary_key.columns)[0]
+        columns = [table.c[key] for key in keys]
+        last_id = None
+        while True:
+            q = select(pk, *columns).order_by(pk).limit(batch_size)
+            if not last_id is None:
+                q = q.where(pk > last_id)
+            rows = session.execute(q).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                for file_path in row[1:]:
+                    if file_path and not isPackRef(file_path):
+                        yield file_path
+            last_id = rows[-1][0]
+
+class FileGC:
+    def __init__(self, session, grace_seconds = 86400, delete = False, workers = 8, exclude = None,\
+            report = None, roots = None):
+        self.session = session
+        if roots is None:
+            # never sweep base_dir itself by default, it is the current directory unless configured
+            if not FileProcess.img_subdir:
+                raise FileImageException('No sweep root given and FileProcess.img_subdir is not set')
+            roots = [FileProcess.img_subdir]
+        if [root for root in roots if path.normpath(root or '.') == '.']:
+            raise FileImageException('Refusing to sweep base_dir itself, give a subdirectory')
+        self.roots = roots
+        self.grace_seconds = grace_seconds
+        self.delete = delete
+        self.workers = workers
+        if exclude is None:
+            exclude = [FileProcess.pack_dir, (FileProcess.rendition_cache or RenditionCache()).cache_dir]
+        self.exclude = set([path.normpath(v) for v in exclude])
+        self.report = report
+        self.referenced = None
+        self.lock = Lock()
+        self.stats = {'dirs': 0, 'files': 0, 'orphans': 0, 'orphan_bytes': 0, 'deleted': 0, 'recent': 0}
+
+    def loadReferenced(self):
+        refs = PathSet()
+        for file_path in referencedPaths(self.session):
+            refs.add(file_path)
+        # nothing below needs the session, don't keep a transaction open during the scan
+        self.session.rollback()
+        self.referenced = refs.freeze()
+        return self.referenced
+
+    def count(self, **deltas):
+        with self.lock:
+            for (key, value) in deltas.items():
+                self.stats[key] += value
+
+    def scanDir(self, rel_dir, queue):
+        full_dir = FileProcess.fullPath(rel_dir)
+        (files, orphans, orphan_bytes, deleted, recent) = (0, 0, 0, 0, 0)
+        cutoff = self.now - self.grace_seconds
+        for entry in scandir(full_dir):
+            rel_path = path.join(rel_dir, entry.name) if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks = False):
+                if not path.normpath(rel_path) in self.exclude:
+                    queue.put(rel_path)
+                continue
+            if not entry.is_file(follow_symlinks = False):
+                continue
+            files += 1
+            if rel_path in self.referenced:
+                continue
+            st = entry.stat(follow_symlinks = False)
+            if st.st_mtime > cutoff:
+                recent += 1
+                continue
+            orphans += 1
+            orphan_bytes += st.st_size
+            if not self.report is None:
+                with self.lock:
+                    self.report(rel_path, st.st_size)
+            if self.delete:
+                try:
+                    unlink(entry.path)
+                    deleted += 1
+                except OSError:
+                    pass
+        self.count(dirs = 1, files = files, orphans = orphans, orphan_bytes = orphan_bytes,\
+                deleted = deleted, recent = recent)
+
+    def worker(self, queue):
+        while True:
+            rel_dir = queue.get()
+            try:
+                if rel_dir is None:
+                    return
+                self.scanDir(rel_dir, queue)
+            except OSError:
+                pass
+            finally:
+                queue.task_done()
+
+    def run(self):
+        if self.referenced is None:
+            self.loadReferenced()
+        self.now = time.time()
+        queue = Queue()
+        threads = [Thread(target = self.worker, args = (queue,)) for v in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for root in self.roots:
+            if path.isdir(FileProcess.fullPath(root)):
+                queue.put(root)
+        queue.join()
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        return self.stats
+
+if __name__ == '__main__':
+    import argparse
+    from conn import session
+    parser = argparse.ArgumentParser(description = 'Find and remove files no row refers to')
+    parser.add_argument('--delete', action = 'store_true')
+    parser.add_argument('--grace-hours', type = float, default = 24)
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--quiet', action = 'store_true')
+    parser.add_argument('--root', action = 'append', help = 'directory under base_dir to sweep')
+    args = parser.parse_args()
+    report = None
+    if not args.quiet:
+        report = lambda file_path, size: print('%s %d' % (file_path, size))
+    try:
+        gc = FileGC(session, grace_seconds = args.grace_hours * 3600, delete = args.delete, workers = args.workers,\
+                report = report, roots = args.root)
+    except FileImageException as e:
+        print(e)
+        sys.exit(1)
+    print(gc.run())
@@ -0,0 +1,162 @@
+import json
+import time
+from os import path
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+from threading import Lock
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum
+        }
+
+class Registry:
+    def __init__(self, slow_query_time = 0.1, slow_query_samples = 50):
+        self.enabled = True
+        self.slow_query_time = slow_query_time
+        self.slow_query_samples = slow_query_samples
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.slow_queries = deque(maxlen = self.slow_query_samples)
+
+    def inc(self, name, value = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(value)
+
+    def addQuery(self, statement, duration):
+        self.observe('db_statement_seconds', duration)
+        if duration >= self.slow_query_time and self.enabled:
+            with self.lock:
+                self.slow_queries.append({'statement': statement, 'seconds': duration, 'time': time.time()})
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': dict([(k, h.snapshot()) for (k, h) in self.histograms.items()]),
+                'slow_queries': list(self.slow_queries)
+            }
+
+registry = Registry()
+
+def timed(name, reg = None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            r = reg or registry
+            if not r.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                r.inc(name + '_errors')
+                raise
+            finally:
+                r.observe(name + '_seconds', time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def fileSize(file_path):
+    try:
+        return path.getsize(file_path)
+    except OSError:
+        return 0
+
+def instrumentEngine(engine, reg = None):
+    # imported here so image workers can use metrics without loading SQLAlchemy
+    from sqlalchemy import event as alchemy_event
+
+    # the start time lives on the execution context, so a failed statement leaves nothing behind
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not context is None:
+            context.metrics_query_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, 'metrics_query_start', None)
+        if start is None:
+            return
+        (reg or registry).addQuery(statement, time.perf_counter() - start)
+
+    def handle_error(context):
+        if not context.execution_context is None:
+            (reg or registry).inc('db_statement_errors')
+
+    alchemy_event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    alchemy_event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    alchemy_event.listen(engine, 'handle_error', handle_error)
+    return engine
+
+def exportSnapshot(reg):
+    return reg.snapshot()
+
+def exportJson(reg):
+    return json.dumps(reg.snapshot(), indent = 2, sort_keys = True)
+
+def prometheusName(name):
+    return 'board_' + ''.join([c if c.isalnum() else '_' for c in name])
+
+def exportPrometheus(reg):
+    snap = reg.snapshot()
+    lines = []
+    for (name, value) in sorted(snap['counters'].items()):
+        name = prometheusName(name) + '_total'
+        lines.append('# TYPE %s counter' % name)
+        lines.append('%s %s' % (name, value))
+    for (name, h) in sorted(snap['histograms'].items()):
+        name = prometheusName(name)
+        lines.append('# TYPE %s histogram' % name)
+        total = 0
+        for (bound, count) in zip(h['buckets'], h['counts']):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, h['count']))
+        lines.append('%s_sum %s' % (name, h['sum']))
+        lines.append('%s_count %d' % (name, h['count']))
+    return '\n'.join(lines) + '\n'
+
+exporters = {
+    'snapshot': exportSnapshot,
+    'json': exportJson,
+    'prometheus': exportPrometheus
+}
+
+def registerExporter(name, func):
+    exporters[name] = func
+
+def export(name = 'snapshot', reg = None):
+    return exporters[name](reg or registry)
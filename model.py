@@ -1,21 +1,84 @@
-from sqlalchemy import *
+from sqlalchemy import Table, Column, Index, ForeignKey, Sequence, Integer, String, Text, Boolean, DateTime,\
+        TIMESTAMP, and_, or_, select, func, text, bindparam
 from sqlalchemy import event as alchemy_event
-from sqlalchemy.orm import relationship, backref, collections
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, backref, collections, Session, object_session,\
+        joinedload, subqueryload, configure_mappers
+from sqlalchemy.orm import object_mapper, make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history, set_committed_value, instance_state
 from sqlalchemy.ext.declarative import declarative_base
 
-from file_image import FileProcess,ImageTransform, mkImageWithFrame
+from file_image import FileProcess,ImageTransform, EncodingProfile, mkImageWithFrame
+from metrics import registry as metrics
+from datetime import datetime, timedelta
+from threading import Lock
+import base64
+import ipaddress
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+from collections import OrderedDict
 import os
 
 class MyBase(object):
-    pass
+    def queueRemovedFile(self, file_path):
+        session = object_session(self)
+        if session is None:
+            self.__dict__.setdefault('_removed_files', []).append(file_path)
+        else:
+            sessionRemovedFiles(session).append(file_path)
+
+    def queueAddedFile(self, file_path):
+        session = object_session(self)
+        if session is None:
+            self.__dict__.setdefault('_added_files', []).append(file_path)
+        else:
+            sessionAddedFiles(session).append(file_path)
+
+def sessionRemovedFiles(session):
+    return session.info.setdefault('removed_files', [])
+
+def sessionAddedFiles(session):
+    return session.info.setdefault('added_files', [])
+
+file_columns = {}
 
 def file_column(column):
     def set_event_listner(target, value, oldvalue, initiator):
-        if oldvalue:
-            full_path = FileProcess.fullPath(oldvalue)
-            if (os.path.isfile(full_path)):
-                os.unlink(full_path)
-    alchemy_event.listen(column, 'set', set_event_listner)
+        if FileProcess.storage == FileProcess.STORE_HASH:
+            return
+        if oldvalue and oldvalue != value:
+            metrics.inc('file_column_replaced')
+            target.queueRemovedFile(oldvalue)
+        if value and oldvalue != value:
+            target.queueAddedFile(value)
+    file_columns.setdefault(column.class_, []).append(column.key)
+    alchemy_event.listen(column, 'set', set_event_listner, active_history=True)
+
+def dayStart(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+def dayEnd(value):
+    if isinstance(value, datetime):
+        return value
+    return dayStart(value) + timedelta(days=1)
+
+def dateRange(column, date_from = None, date_to = None):
+    # Always a half-open [start, end) range on the bare column, so an index
+    # on it can be used. A date bound covers the whole day, a datetime is exact,
+    # a missing bound leaves that side open.
+    clauses = []
+    if not date_from is None:
+        clauses.append(column >= dayStart(date_from))
+    if not date_to is None:
+        clauses.append(column < dayEnd(date_to))
+    return and_(*clauses)
+
+def onDay(column, day):
+    return dateRange(column, day, day)
 
 Base = declarative_base(cls=MyBase)
 metadata = Base.metadata
@@ -23,6 +86,58 @@ metadata = Base.metadata
 class ModelExteption(Exception):
     pass
 
+class LookupCache:
+    def __init__(self, cls, *keys):
+        self.cls = cls
+        self.keys = keys
+        self.entries = {}
+        self.lock = Lock()
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            alchemy_event.listen(cls, name, self.changeListener)
+
+    def changeListener(self, mapper, connection, target):
+        self.clear()
+        session = object_session(target)
+        if not session is None:
+            session.info.setdefault('lookup_caches', set()).add(self)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, session, key, value):
+        with self.lock:
+            cached = self.entries.get((key, value))
+        if cached is None:
+            obj = session.query(self.cls).filter(getattr(self.cls, key) == value).first()
+            # rows this session wrote may still be rolled back, don't hand them to other sessions
+            if not obj is None and not self in session.info.get('lookup_caches', ()):
+                self.add(obj)
+            return obj
+        obj = session.identity_map.get(instance_state(cached).key)
+        if obj is None:
+            obj = session.merge(cached, load=False)
+        return obj
+
+    def add(self, obj):
+        mapper = object_mapper(obj)
+        cached = mapper.class_manager.new_instance()
+        for prop in mapper.column_attrs:
+            set_committed_value(cached, prop.key, getattr(obj, prop.key))
+        make_transient_to_detached(cached)
+        with self.lock:
+            for key in self.keys:
+                self.entries[(key, getattr(obj, key))] = cached
+
+def lookup_caches_after_transaction(session, transaction):
+    # the outer transaction ends on commit, rollback and close alike
+    if not transaction.parent is None:
+        return
+    for cache in session.info.pop('lookup_caches', []):
+        cache.clear()
+
+alchemy_event.listen(Session, 'after_transaction_end', lookup_caches_after_transaction)
+
 class EventSourceType:
     EMPTY = 0
     STD = 1
@@ -33,39 +148,43 @@ class Entity:
     EVENT = 1
 
 event_persons = Table('event_persons', metadata,
-    Column('event_id', Integer, ForeignKey('events.event_id')),
-    Column('person_id', Integer, ForeignKey('persons.person_id')),
+    Column('event_id', Integer, ForeignKey('events.event_id'), index=True),
+    Column('person_id', Integer, ForeignKey('persons.person_id'), index=True),
     Column('order', Integer)
 )
 
 event_links = Table('event_links', metadata,
-    Column('event_id', Integer, ForeignKey('events.event_id')),
+    Column('event_id', Integer, ForeignKey('events.event_id'), index=True),
     Column('link_id', Integer, ForeignKey('links.link_id')),
     Column('order', Integer)
 )
 
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (
+        Index('ix_events_event_type_time_start', 'event_type_id', 'time_start'),
+    )
 
     event_id = Column(Integer, Sequence('event_id_seq'), primary_key=True)
-    place_id = Column(Integer, ForeignKey('places.place_id')) 
+    place_id = Column(Integer, ForeignKey('places.place_id'), index=True) 
     main_image_id = Column(Integer, ForeignKey('images.image_id'))
     title = Column(String(255))
-    time_start = Column(DateTime)
+    time_start = Column(DateTime, index=True)
     time_end = Column(DateTime)
     description = Column(Text)
     event_type_id = Column(Integer, ForeignKey('event_types.event_type_id')) 
     source_type = Column(Integer) 
-    source_url = Column(String(255))
+    source_url = Column(String(255), index=True)
     last_status = Column(Integer)
 
     place = relationship("Place", backref=backref('events'))
-    persons = relationship("Person", secondary=event_persons)
     main_image = relationship("Image")
     event_type = relationship("EventType")
     event_status_list = relationship("EventStatus", backref=backref('event'))
-    persons = relationship('Person', secondary=event_persons, backref=backref('events'))
-    links = relationship('Link', secondary=event_links)
+    persons = relationship('Person', secondary=event_persons, order_by=event_persons.c.order,\
+            backref=backref('events'))
+    links = relationship('Link', secondary=event_links, order_by=event_links.c.order)
+    status_counts = relationship('EventStatusCount', viewonly=True)
 
     def __init__(self, event_type, title = None):
         self.event_type = event_type
@@ -73,6 +192,48 @@ class Event(Base):
             title = ''
         self.title = title
 
+    @classmethod
+    def listing(cls, session, event_type = None, date_from = None, date_to = None, place = None,\
+            limit = None, offset = None):
+        q = session.query(cls).options(
+                joinedload(cls.place),
+                joinedload(cls.event_type),
+                joinedload(cls.main_image),
+                subqueryload(cls.persons),
+                subqueryload(cls.links))
+        if isinstance(event_type, EventType):
+            q = q.filter(cls.event_type_id == event_type.event_type_id)
+        elif not event_type is None:
+            q = q.join(EventType, cls.event_type_id == EventType.event_type_id).\
+                    filter(EventType.name == event_type)
+        if not date_from is None or not date_to is None:
+            q = q.filter(dateRange(cls.time_start, date_from, date_to))
+        if not place is None:
+            q = q.filter(cls.place_id == getattr(place, 'place_id', place))
+        q = q.order_by(cls.time_start, cls.event_id)
+        if not limit is None:
+            q = q.limit(limit)
+        if not offset is None:
+            q = q.offset(offset)
+        return q.all()
+
+    @classmethod
+    def stream(cls, session, chunk_size = 1000, cursor = None, filters = None, rows = False,\
+            as_dict = False):
+        return EventStream(session, chunk_size = chunk_size, cursor = cursor, filters = filters,\
+                rows = rows, as_dict = as_dict)
+
+    def statusCount(self, status):
+        for sc in self.status_counts:
+            if sc.status == status:
+                return sc.status_count
+        return 0
+
+    def addLinks(self, session, urls):
+        links = Link.fromUrls(session, urls)
+        self.links.extend(links)
+        return links
+
     def addEventStatus(self, event_status):
         self.last_status = event_status.status
         self.event_status_list.append(event_status)
@@ -80,11 +241,87 @@ class Event(Base):
     def __repr__(self):
         return "Event('%s')" % (self.title)
 
+class EventStream:
+    TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+    def __init__(self, session, chunk_size = 1000, cursor = None, filters = None, rows = False,\
+            as_dict = False):
+        self.session = session
+        self.chunk_size = chunk_size
+        self.cursor = cursor
+        self.filters = filters or []
+        self.rows = rows or as_dict
+        self.as_dict = as_dict
+
+    @staticmethod
+    def encodeCursor(time_start, event_id):
+        token = '%s|%d' % (time_start.isoformat(), event_id)
+        return base64.urlsafe_b64encode(token.encode('ascii')).decode('ascii')
+
+    @staticmethod
+    def decodeCursor(cursor):
+        try:
+            (time_start, event_id) = base64.urlsafe_b64decode(str(cursor)).decode('ascii').split('|')
+            for time_format in EventStream.TIME_FORMATS:
+                try:
+                    return (datetime.strptime(time_start, time_format), int(event_id))
+                except ValueError:
+                    pass
+        except (TypeError, ValueError):
+            pass
+        raise ModelExteption("Bad event cursor '%s'" % cursor)
+
+    def query(self):
+        if self.rows:
+            q = self.session.query(*Event.__table__.c)
+        else:
+            q = self.session.query(Event)
+        # rows without time_start have no place in the keyset order
+        q = q.filter(Event.time_start != None)
+        for criterion in self.filters:
+            q = q.filter(criterion)
+        return q.order_by(Event.time_start, Event.event_id)
+
+    def __iter__(self):
+        position = None
+        if self.cursor:
+            position = self.decodeCursor(self.cursor)
+        while True:
+            q = self.query()
+            if not position is None:
+                (time_start, event_id) = position
+                q = q.filter(or_(Event.time_start > time_start,\
+                        and_(Event.time_start == time_start, Event.event_id > event_id)))
+            chunk = q.limit(self.chunk_size).all()
+            for item in chunk:
+                position = (item.time_start, item.event_id)
+                self.cursor = self.encodeCursor(*position)
+                if self.as_dict:
+                    item = dict(zip(Event.__table__.c.keys(), item))
+                yield item
+            if len(chunk) < self.chunk_size:
+                return
+
 def event_status_append_listener(target, value, initiator):
     target.last_status = value.status
 
 alchemy_event.listen(Event.event_status_list, 'append', event_status_append_listener)
 
+def event_order_after_flush(session, flush_context):
+    # the ORM only writes the keys of association rows, number them in list order
+    for (key, table, column) in [('persons', event_persons, 'person_id'), ('links', event_links, 'link_id')]:
+        rows = []
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Event) and get_history(obj, key).has_changes():
+                for (order, item) in enumerate(getattr(obj, key)):
+                    rows.append({'b_event_id': obj.event_id, 'b_item_id': getattr(item, column), 'b_order': order})
+        if rows:
+            session.execute(table.update().\
+                    where(and_(table.c.event_id == bindparam('b_event_id'), table.c[column] == bindparam('b_item_id'))).\
+                    values({'order': bindparam('b_order')}), rows)
+
+alchemy_event.listen(Session, 'after_flush', event_order_after_flush)
+
 class EventStatus(Base):
     EMPTY = 0
     LIVE_WANT = 1
@@ -104,12 +341,111 @@ class EventStatus(Base):
     def __repr__(self):
         return "EventStatus('%s')" % (self.status)
 
+    @classmethod
+    def bulkAdd(cls, session, changes):
+        rows = []
+        deltas = {}
+        last_status = OrderedDict()
+        for change in changes:
+            (event_id, status) = change[0:2]
+            description = change[2] if len(change) > 2 else None
+            rows.append({'event_id': event_id, 'status': status, 'description': description})
+            deltas[(event_id, status)] = deltas.get((event_id, status), 0) + 1
+            last_status[event_id] = status
+        if not rows:
+            return
+        session.execute(cls.__table__.insert(), rows)
+        connection = session.connection()
+        for ((event_id, status), delta) in deltas.items():
+            EventStatusCount.adjust(connection, event_id, status, delta)
+        events = Event.__table__
+        session.execute(events.update().where(events.c.event_id == bindparam('b_event_id')).\
+                values(last_status = bindparam('b_last_status')),
+                [{'b_event_id': k, 'b_last_status': v} for (k, v) in last_status.items()])
+
+def event_status_after_insert(mapper, connection, target):
+    EventStatusCount.adjust(connection, target.event_id, target.status, 1)
+
+def event_status_after_update(mapper, connection, target):
+    history = get_history(target, 'event_id')
+    (old_event_id,) = history.deleted or [target.event_id]
+    history = get_history(target, 'status')
+    (old_status,) = history.deleted or [target.status]
+    if (old_event_id, old_status) != (target.event_id, target.status):
+        EventStatusCount.adjust(connection, old_event_id, old_status, -1)
+        EventStatusCount.adjust(connection, target.event_id, target.status, 1)
+
+def event_status_after_delete(mapper, connection, target):
+    EventStatusCount.adjust(connection, target.event_id, target.status, -1)
+
+def event_before_delete(mapper, connection, target):
+    EventStatusCount.deleteForEvent(connection, target.event_id)
+
+alchemy_event.listen(EventStatus, 'after_insert', event_status_after_insert)
+alchemy_event.listen(EventStatus, 'after_update', event_status_after_update)
+alchemy_event.listen(EventStatus, 'after_delete', event_status_after_delete)
+alchemy_event.listen(Event, 'before_delete', event_before_delete)
+
+class EventStatusCount(Base):
+    __tablename__ = 'event_status_counts'
+
+    event_id = Column(Integer, ForeignKey('events.event_id'), primary_key=True, autoincrement=False)
+    status = Column(Integer, primary_key=True, autoincrement=False)
+    status_count = Column(Integer)
+
+    @classmethod
+    def adjust(cls, connection, event_id, status, delta):
+        if event_id is None or not delta:
+            return
+        table = cls.__table__
+        where = and_(table.c.event_id == event_id, table.c.status == status)
+        update = table.update().where(where).values(status_count = table.c.status_count + delta)
+        ret = connection.execute(update)
+        if ret.rowcount == 0 and delta > 0:
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(table.insert().values(event_id = event_id, status = status,\
+                        status_count = delta))
+                savepoint.commit()
+            except IntegrityError:
+                # another writer inserted the row since our update
+                savepoint.rollback()
+                connection.execute(update)
+
+    @classmethod
+    def deleteForEvent(cls, connection, event_id):
+        connection.execute(cls.__table__.delete().where(cls.__table__.c.event_id == event_id))
+
+    @classmethod
+    def forEvents(cls, session, event_ids):
+        ret = dict((event_id, {}) for event_id in event_ids)
+        if ret:
+            q = session.query(cls.event_id, cls.status, cls.status_count).\
+                    filter(cls.event_id.in_(list(ret.keys())))
+            for (event_id, status, status_count) in q:
+                ret[event_id][status] = status_count
+        return ret
+
+    @classmethod
+    def rebuild(cls, session):
+        table = cls.__table__
+        es = EventStatus.__table__
+        q = session.query(es.c.event_id, es.c.status, func.count(es.c.event_status_id)).\
+                filter(es.c.event_id != None).\
+                group_by(es.c.event_id, es.c.status)
+        session.execute(table.delete())
+        session.execute(table.insert().from_select(['event_id', 'status', 'status_count'], q.statement))
+        session.commit()
+
+    def __repr__(self):
+        return "EventStatusCount(%s, %s, %s)" % (self.event_id, self.status, self.status_count)
+
 
 class Place(Base):
     __tablename__ = 'places'
 
     place_id = Column(Integer, Sequence('place_id_seq'), primary_key=True)
-    title_name = Column(String(255))
+    title_name = Column(String(255), index=True)
     address = Column(String(255))
     phone = Column(String(255))
     site_url = Column(String(255))
@@ -141,24 +477,55 @@ class Image(Base):
     def __repr__(self):
         return "Image('%s')" % (self.image_path)
 
+    def ingestJob(self, source_file):
+        image_type = self.image_type
+        return (FileProcess().settings(), source_file, image_type.thumb_transform_image, image_type.base_dir,\
+                image_type.encoding_profile)
+
     def uploadFromFile(self, source_file):
         image_type = self.image_type
         fp = FileProcess()
-        thumb_info = fp.copyImage(source_file, transform = image_type.thumb_transform_image,\
-                short_dir = image_type.base_dir)
-        if not thumb_info or not thumb_info.is_image():
-            return False
-        image_info = fp.copyImage(source_file, short_dir = image_type.base_dir)
-        if not image_info or not image_info.is_image():
+        (image_info, thumb_info) = fp.ingestImage(source_file, transform = image_type.thumb_transform_image,\
+                short_dir = image_type.base_dir, profile = image_type.encoding_profile)
+        if not image_info or not thumb_info:
             return False
-        self.thumb_path = thumb_info.short_path
-        self.thumb_width = thumb_info.width
-        self.thumb_height = thumb_info.height
+        self.setFileInfo(image_info, thumb_info)
+        return True
+
+    @classmethod
+    def uploadFromFiles(cls, image_type, source_files, processes = None):
+        fp = FileProcess()
+        results = fp.ingestImages(source_files, transform = image_type.thumb_transform_image,\
+                short_dir = image_type.base_dir, processes = processes, profile = image_type.encoding_profile)
+        ret = []
+        for result in results:
+            img = None
+            if result:
+                img = cls(image_type)
+                img.setFileInfo(result.image_info, result.thumb_info)
+            ret.append((img, result))
+        return ret
+
+    def renditionPath(self, name, cache = None):
+        rendition = self.image_type.findRendition(name)
+        if rendition is None:
+            raise ModelExteption("Cant find rendition %s" % name)
+        if cache is None:
+            cache = FileProcess.renditionCache()
+        return cache.get(self.image_path, rendition.cache_key, rendition.transform_image,\
+                self.image_type.encoding_profile)
+
+    def setFileInfo(self, image_info, thumb_info):
+        self.setThumbInfo(thumb_info)
         self.image_path = image_info.short_path
         self.image_width = image_info.width
         self.image_height = image_info.height
         self.content_type = image_info.content_type
-        return True
+
+    def setThumbInfo(self, thumb_info):
+        self.thumb_path = thumb_info.short_path
+        self.thumb_width = thumb_info.width
+        self.thumb_height = thumb_info.height
 
 file_column(Image.image_path)
 file_column(Image.thumb_path)
@@ -177,6 +544,12 @@ class ImageType(Base):
     def_thumb_path = Column(String(255))
     base_dir = Column(String(255))
     transform_type = Column(Integer)
+    encoding_type = Column(Integer)
+    encoding_quality = Column(Integer)
+    encoding_progressive = Column(Boolean)
+    encoding_optimize = Column(Boolean)
+    encoding_strip = Column(Boolean)
+    encoding_max_bytes = Column(Integer)
 
     def __init__(self, target_type, title_name = ''):
         self.target_type = target_type
@@ -185,32 +558,92 @@ class ImageType(Base):
     def __repr__(self):
         return "ImageType('%s')" % (self.title_name)
 
-    def mkDefThumb(self):
-        info = mkImageWithFrame(self.max_thumb_width, self.max_thumb_height)
-        if not info.is_image():
-            return False
-        fp = FileProcess()
-        image_info = fp.copyImage(info.file_path, short_dir = self.base_dir)
+    @staticmethod
+    def mkDefThumbInfo(width, height, base_dir = None):
+        info = mkImageWithFrame(width, height)
+        try:
+            if not info.is_image():
+                return None
+            image_info = FileProcess().copyImage(info.file_path, short_dir = base_dir)
+        finally:
+            os.unlink(info.file_path)
         if not image_info or not image_info.is_image():
+            return None
+        return image_info
+
+    def mkDefThumb(self):
+        info = self.mkDefThumbInfo(self.max_thumb_width, self.max_thumb_height, self.base_dir)
+        return self.setDefThumb(info)
+
+    def setDefThumb(self, image_info):
+        if image_info is None:
             return False
         self.def_thumb_path = image_info.short_path
         return True
 
     @property
     def thumb_transform_image(self):
-        return ImageTransform.create(self.transform_type,\
+        return ImageTransform.get(self.transform_type,\
                 width = self.max_thumb_width,\
                 height = self.max_thumb_height)
 
+    @property
+    def encoding_profile(self):
+        return EncodingProfile(content_type = self.encoding_type,\
+                quality = self.encoding_quality,\
+                progressive = bool(self.encoding_progressive),\
+                optimize = bool(self.encoding_optimize),\
+                strip_metadata = self.encoding_strip,\
+                max_bytes = self.encoding_max_bytes)
+
+    @classmethod
+    def find(cls, session, image_type_id):
+        return image_type_cache.get(session, 'image_type_id', image_type_id)
+
+    def findRendition(self, name):
+        for rendition in self.renditions:
+            if rendition.name == name:
+                return rendition
+        return None
+
 file_column(ImageType.def_thumb_path)
 
+class ImageRendition(Base):
+    __tablename__ = 'image_renditions'
+
+    rendition_id = Column(Integer, Sequence('rendition_id_seq'), primary_key=True)
+    image_type_id = Column(Integer, ForeignKey('image_types.image_type_id'))
+    name = Column(String(255))
+    width = Column(Integer)
+    height = Column(Integer)
+    transform_type = Column(Integer)
+
+    image_type = relationship('ImageType', backref=backref('renditions'))
+
+    def __init__(self, name, width, height, transform_type = ImageTransform.STD):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.transform_type = transform_type
+
+    def __repr__(self):
+        return "ImageRendition('%s')" % (self.name)
+
+    @property
+    def cache_key(self):
+        return '%s-%sx%s-%s' % (self.name, self.width, self.height, self.transform_type)
+
+    @property
+    def transform_image(self):
+        return ImageTransform.get(self.transform_type, width = self.width, height = self.height)
+
 class Person(Base):
     MUSICIAN = 1
 
     __tablename__ = 'persons'
 
     person_id = Column(Integer, Sequence('person_id_seq'), primary_key=True)
-    name = Column(String(255))
+    name = Column(String(255), index=True)
     source_url = Column(String(255))
     thumb_image_id = Column(Integer, ForeignKey('images.image_id'))
     person_type = Column(Integer)
@@ -228,17 +661,21 @@ class EventType(Base):
     __tablename__ = 'event_types'
 
     event_type_id = Column(Integer, Sequence('event_type_id_seq'), primary_key=True) 
-    name = Column(String(255))
+    name = Column(String(255), unique=True)
     title = Column(String(255))
 
     @classmethod
     def findByName(cls, session, name):
-        ret = session.query(cls).filter(cls.name == name).one()
+        ret = event_type_cache.get(session, 'name', name)
         if ret:
             return ret
         else:
             raise ModelExteption("Cant find this event type %s" % name)
 
+    @classmethod
+    def find(cls, session, event_type_id):
+        return event_type_cache.get(session, 'event_type_id', event_type_id)
+
     def __init__(self, name, title):
         self.name = name
         self.title = title
@@ -255,30 +692,344 @@ class Link(Base):
 
     link_id = Column(Integer, Sequence('link_id_seq'), primary_key=True)
     title = Column(String(255))
-    url = Column(String(255))
-    domain_id = Column(String(255), ForeignKey('link_domains.domain_id'))
+    url = Column(String(255), index=True)
+    domain_id = Column(Integer, ForeignKey('link_domains.domain_id'))
     link_type = Column(Integer)
 
     link_domain = relationship('LinkDomain')
 
+    @classmethod
+    def fromUrls(cls, session, urls, link_type = None):
+        if link_type is None:
+            link_type = cls.TYPE_STD
+        domain_ids = LinkDomain.resolveUrls(session, urls)
+        links = []
+        for url in urls:
+            link = cls(url)
+            link.domain_id = domain_ids.get(url)
+            link.link_type = link_type
+            links.append(link)
+        return links
+
     def __init__(self, url):
         self.url = url
 
     def __repr__(self):
         return "Link('%s')" % (self.url)
 
+sprite_images = Table('sprite_images', metadata,
+    Column('sprite_id', Integer, ForeignKey('sprites.sprite_id'), primary_key=True),
+    Column('image_id', Integer, ForeignKey('images.image_id'), primary_key=True, index=True),
+    Column('x', Integer),
+    Column('y', Integer),
+    Column('width', Integer),
+    Column('height', Integer),
+    Column('thumb_path', String(255))
+)
+
+class Sprite(Base):
+    __tablename__ = 'sprites'
+
+    sprite_id = Column(Integer, Sequence('sprite_id_seq'), primary_key=True)
+    name = Column(String(255), unique=True)
+    sprite_path = Column(String(255))
+    width = Column(Integer)
+    height = Column(Integer)
+    stale = Column(Boolean, default=False)
+
+    def __init__(self, name):
+        self.name = name
+        self.stale = False
+
+    def __repr__(self):
+        return "Sprite('%s')" % (self.name)
+
+    @classmethod
+    def findByName(cls, session, name):
+        return session.query(cls).filter(cls.name == name).first()
+
+    def members(self, session):
+        if self.sprite_id is None:
+            return {}
+        q = session.query(sprite_images).filter(sprite_images.c.sprite_id == self.sprite_id)
+        return dict([(row.image_id, row) for row in q])
+
+    def manifest(self, session):
+        images = {}
+        for (image_id, row) in self.members(session).items():
+            images[image_id] = {'x': row.x, 'y': row.y, 'width': row.width, 'height': row.height}
+        return {
+            'url': FileProcess.fullUrl(self.sprite_path),
+            'width': self.width,
+            'height': self.height,
+            'images': images
+        }
+
+file_column(Sprite.sprite_path)
+
+def sprite_before_flush(session, flush_context, instances):
+    changed = [obj.image_id for obj in session.dirty\
+            if type(obj) is Image and get_history(obj, 'thumb_path').has_changes()]
+    deleted = [obj.image_id for obj in session.deleted if type(obj) is Image]
+    ids = [v for v in changed + deleted if not v is None]
+    if not ids:
+        return
+    members = select(sprite_images.c.sprite_id).where(sprite_images.c.image_id.in_(ids))
+    session.execute(Sprite.__table__.update().where(Sprite.__table__.c.sprite_id.in_(members)).\
+            values(stale = True))
+    if deleted:
+        session.execute(sprite_images.delete().where(sprite_images.c.image_id.in_(deleted)))
+
+alchemy_event.listen(Session, 'before_flush', sprite_before_flush)
+
+class FileRef(Base):
+    __tablename__ = 'file_refs'
+
+    file_path = Column(String(255), primary_key=True)
+    ref_count = Column(Integer)
+
+    @classmethod
+    def adjust(cls, session, deltas):
+        table = cls.__table__
+        removed = []
+        for (file_path, delta) in deltas.items():
+            if not delta:
+                continue
+            by_path = table.c.file_path == file_path
+            ret = session.execute(table.update().where(by_path).\
+                    values(ref_count = table.c.ref_count + delta))
+            if ret.rowcount == 0:
+                if delta > 0:
+                    session.execute(table.insert().values(file_path = file_path, ref_count = delta))
+                else:
+                    removed.append(file_path)
+                continue
+            if delta < 0:
+                ret = session.execute(table.delete().where(and_(by_path, table.c.ref_count <= 0)))
+                if ret.rowcount:
+                    removed.append(file_path)
+        return removed
+
+    def __repr__(self):
+        return "FileRef('%s', %s)" % (self.file_path, self.ref_count)
+
+def fileRefDeltas(session):
+    deltas = {}
+    for (objs, is_deleted) in [(session.new, False), (session.dirty, False), (session.deleted, True)]:
+        for obj in objs:
+            for key in file_columns.get(type(obj), []):
+                history = get_history(obj, key)
+                if is_deleted:
+                    added = []
+                    removed = list(history.deleted) + list(history.unchanged)
+                else:
+                    added = history.added
+                    removed = history.deleted
+                for v in added:
+                    if v:
+                        deltas[v] = deltas.get(v, 0) + 1
+                for v in removed:
+                    if v:
+                        deltas[v] = deltas.get(v, 0) - 1
+    return deltas
+
+def file_column_before_flush(session, flush_context, instances):
+    removed = sessionRemovedFiles(session)
+    added = sessionAddedFiles(session)
+    for obj in session.new:
+        removed.extend(obj.__dict__.pop('_removed_files', []))
+        added.extend(obj.__dict__.pop('_added_files', []))
+    if FileProcess.storage == FileProcess.STORE_HASH:
+        # Another session may be reusing a hashed file right now without a reference written yet,
+        # so files that drop to zero references are left to the file GC and its grace period.
+        FileRef.adjust(session, fileRefDeltas(session))
+
+def file_column_after_commit(session):
+    session.info.pop('added_files', None)
+    removed = session.info.pop('removed_files', None)
+    if removed:
+        FileProcess.removeFilesLater(removed)
+
+def file_column_after_transaction_end(session, transaction):
+    # commit has already taken both lists, anything left was rolled back or closed
+    if not transaction.parent is None:
+        return
+    session.info.pop('removed_files', None)
+    # files written for values that never got committed
+    added = session.info.pop('added_files', None)
+    if added:
+        FileProcess.removeFilesLater(added)
+
+alchemy_event.listen(Session, 'before_flush', file_column_before_flush)
+alchemy_event.listen(Session, 'after_commit', file_column_after_commit)
+alchemy_event.listen(Session, 'after_transaction_end', file_column_after_transaction_end)
+
 class LinkDomain(Base):
     __tablename__ = 'link_domains'
 
     domain_id = Column(Integer, Sequence('domain_id_seq'), primary_key=True)
-    domain = Column(String(255))
+    domain = Column(String(255), unique=True)
     def_link_title = Column(String(255))
-    domain_image_id = Column(String(255), ForeignKey('images.image_id')) 
+    domain_image_id = Column(Integer, ForeignKey('images.image_id')) 
 
     domain_image = relationship('Image')
 
+    @classmethod
+    def findByDomain(cls, session, domain):
+        return link_domain_cache.get(session, 'domain', domain)
+
+    @classmethod
+    def resolveUrls(cls, session, urls):
+        return link_domain_index.resolveUrls(session, urls)
+
     def __init__(self, domain):
         self.domain = domain
 
     def __repr__(self):
         return "LinkDomain('%s')" % (self.domain)
+
+MULTI_PART_SUFFIXES = set(['co.uk', 'org.uk', 'com.ua', 'org.ua', 'net.ua', 'kiev.ua', 'in.ua',\
+        'com.ru', 'org.ru', 'net.ru', 'spb.ru', 'msk.ru', 'com.by', 'com.au', 'co.jp'])
+
+def urlHost(url):
+    if not url:
+        return None
+    if not '://' in url:
+        url = 'http://' + url
+    try:
+        host = urlparse(url.strip()).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    host = host.rstrip('.')
+    try:
+        host = host.encode('idna').decode('ascii')
+    except UnicodeError:
+        pass
+    if host.startswith('www.'):
+        host = host[4:]
+    return host or None
+
+def isIpHost(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+def registrableDomain(host):
+    if isIpHost(host):
+        return host
+    labels = host.split('.')
+    if len(labels) > 2 and '.'.join(labels[-2:]) in MULTI_PART_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+def insertMissing(connection, table, rows):
+    # rows another writer inserted meanwhile hit a unique key, skip those and keep the rest
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert(), rows)
+        savepoint.commit()
+        return
+    except IntegrityError:
+        savepoint.rollback()
+    for row in rows:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert(), [row])
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+
+class LinkDomainIndex:
+    def __init__(self):
+        self.domains = None
+        self.lock = Lock()
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            alchemy_event.listen(LinkDomain, name, self.changeListener)
+        alchemy_event.listen(Session, 'after_commit', self.afterCommit)
+        alchemy_event.listen(Session, 'after_transaction_end', self.afterTransactionEnd)
+
+    def changeListener(self, mapper, connection, target):
+        self.clear()
+        session = object_session(target)
+        if not session is None:
+            session.info.setdefault('lookup_caches', set()).add(self)
+
+    def afterCommit(self, session):
+        overlay = session.info.pop(self, None)
+        if not overlay:
+            return
+        with self.lock:
+            if not self.domains is None:
+                domains = dict(self.domains)
+                domains.update(overlay)
+                self.domains = domains
+
+    def afterTransactionEnd(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop(self, None)
+
+    def clear(self):
+        with self.lock:
+            self.domains = None
+
+    def load(self, session):
+        table = LinkDomain.__table__
+        return dict(session.query(table.c.domain, table.c.domain_id))
+
+    def lookup(self, domains, host):
+        if isIpHost(host):
+            return domains.get(host)
+        labels = host.split('.')
+        for v in range(len(labels)):
+            domain_id = domains.get('.'.join(labels[v:]))
+            if not domain_id is None:
+                return domain_id
+        return None
+
+    def resolveUrls(self, session, urls):
+        with self.lock:
+            domains = self.domains
+        if domains is None:
+            domains = self.load(session)
+            # whatever this session wrote is not committed yet, so don't share what it sees
+            if not self in session.info and not self in session.info.get('lookup_caches', ()):
+                with self.lock:
+                    self.domains = domains
+        overlay = session.info.get(self)
+        if overlay:
+            domains = dict(domains)
+            domains.update(overlay)
+        hosts = {}
+        for url in set(urls):
+            host = urlHost(url)
+            if host:
+                hosts[url] = host
+        missing = set([registrableDomain(host) for host in hosts.values()\
+                if self.lookup(domains, host) is None])
+        if missing:
+            table = LinkDomain.__table__
+            insertMissing(session.connection(), table, [{'domain': domain} for domain in missing])
+            q = session.query(table.c.domain, table.c.domain_id).filter(table.c.domain.in_(list(missing)))
+            added = dict(q)
+            # new rows are only safe to share once committed
+            session.info.setdefault(self, {}).update(added)
+            domains = dict(domains)
+            domains.update(added)
+        return dict([(url, self.lookup(domains, host)) for (url, host) in hosts.items()])
+
+event_type_cache = LookupCache(EventType, 'name', 'event_type_id')
+image_type_cache = LookupCache(ImageType, 'image_type_id')
+link_domain_cache = LookupCache(LinkDomain, 'domain', 'domain_id')
+link_domain_index = LinkDomainIndex()
+
+def startup(engine = None):
+    # run mapper configuration up front instead of inside the first request
+    configure_mappers()
+    import search
+    search.enable()
+    if not engine is None:
+        engine.connect().close()
@@ -0,0 +1,250 @@
+import os
+import mmap
+import errno
+import fcntl
+import struct
+import binascii
+from contextlib import contextmanager
+from os import path, listdir, unlink
+from threading import Lock
+
+PACK_PREFIX = 'pack:'
+
+def isPackRef(file_path):
+    return bool(file_path) and str(file_path).startswith(PACK_PREFIX)
+
+class PackStoreException(Exception):
+    pass
+
+class Pack:
+    def __init__(self, pack_dir, pack_no):
+        self.pack_no = pack_no
+        self.data_path = path.join(pack_dir, '%06d.pack' % pack_no)
+        self.index_path = path.join(pack_dir, '%06d.idx' % pack_no)
+        self.index_pos = 0
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.map = None
+
+    def view(self, offset, size):
+        if size == 0:
+            return memoryview(b'')
+        if self.map is None or offset + size > len(self.map):
+            # the pack grew since it was mapped; the old map goes away with its last view
+            try:
+                with open(self.data_path, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError):
+                raise PackStoreException("Cant map pack '%s'" % self.data_path)
+        data = memoryview(self.map)[offset:offset + size]
+        if len(data) != size:
+            raise PackStoreException("Pack '%s' is shorter than its index" % self.data_path)
+        return data
+
+    def size(self):
+        try:
+            return path.getsize(self.data_path)
+        except OSError:
+            return 0
+
+class PackStore:
+    RECORD = struct.Struct('<20sQI')
+    DELETED = 0xffffffff
+    LOCK_NAME = 'LOCK'
+
+    def __init__(self, pack_dir, max_pack_bytes = 256 * 1024 * 1024):
+        self.pack_dir = pack_dir
+        self.max_pack_bytes = max_pack_bytes
+        self.packs = None
+        self.index = None
+        self.generation = None
+        self.lock = Lock()
+
+    @contextmanager
+    def locked(self, mode = fcntl.LOCK_SH):
+        # Writers and readers share the store lock, compact() takes it exclusively and bumps
+        # the generation kept in the lock file, so everyone else reloads instead of trusting
+        # offsets into packs that were removed or recreated under the same name.
+        with self.lock:
+            if not path.isdir(self.pack_dir):
+                os.makedirs(self.pack_dir)
+            with open(path.join(self.pack_dir, self.LOCK_NAME), 'a+') as f:
+                fcntl.flock(f.fileno(), mode)
+                try:
+                    f.seek(0)
+                    generation = int(f.read() or 0)
+                    if self.packs is None or generation != self.generation:
+                        self.load()
+                        self.generation = generation
+                    yield f
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def ref(key):
+        return PACK_PREFIX + binascii.hexlify(key).decode('ascii')
+
+    @staticmethod
+    def refKey(ref):
+        if not isPackRef(ref):
+            raise PackStoreException("Not a pack reference '%s'" % ref)
+        try:
+            key = binascii.unhexlify(ref[len(PACK_PREFIX):])
+        except (TypeError, ValueError):
+            raise PackStoreException("Bad pack reference '%s'" % ref)
+        if len(key) != 20:
+            raise PackStoreException("Bad pack reference '%s'" % ref)
+        return key
+
+    def load(self):
+        self.packs = {}
+        self.index = {}
+        self.refresh()
+
+    def refresh(self):
+        if not path.isdir(self.pack_dir):
+            os.makedirs(self.pack_dir)
+        pack_nos = sorted([int(name[:-4]) for name in listdir(self.pack_dir) if name.endswith('.idx')])
+        if [v for v in self.packs if not v in pack_nos]:
+            # another process compacted packs away, start over
+            self.packs = {}
+            self.index = {}
+        for pack_no in pack_nos:
+            if not pack_no in self.packs:
+                self.packs[pack_no] = Pack(self.pack_dir, pack_no)
+            self.readIndex(self.packs[pack_no])
+
+    def readIndex(self, pack):
+        try:
+            with open(pack.index_path, 'rb') as f:
+                f.seek(pack.index_pos)
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        # a trailing partial record is still being written by someone else
+        count = len(data) // self.RECORD.size
+        for v in range(count):
+            (key, offset, size) = self.RECORD.unpack_from(data, v * self.RECORD.size)
+            self.applyRecord(pack, key, offset, size)
+        pack.index_pos += count * self.RECORD.size
+
+    def applyRecord(self, pack, key, offset, size):
+        old = self.index.pop(key, None)
+        if not old is None:
+            old_pack = self.packs.get(old[0])
+            if not old_pack is None:
+                old_pack.live_bytes -= old[2]
+                old_pack.dead_bytes += old[2]
+        if size == self.DELETED:
+            return
+        self.index[key] = (pack.pack_no, offset, size)
+        pack.live_bytes += size
+
+    def activePack(self, size, sealed = ()):
+        if self.packs:
+            pack = self.packs[max(self.packs)]
+            if not pack.pack_no in sealed and pack.size() + size <= self.max_pack_bytes:
+                return pack
+            pack_no = pack.pack_no + 1
+        else:
+            pack_no = 1
+        pack = self.packs[pack_no] = Pack(self.pack_dir, pack_no)
+        return pack
+
+    def writeRecord(self, pack, key, data = None):
+        with open(pack.index_path, 'ab') as fi:
+            fcntl.flock(fi.fileno(), fcntl.LOCK_EX)
+            try:
+                if data is None:
+                    fi.write(self.RECORD.pack(key, 0, self.DELETED))
+                else:
+                    with open(pack.data_path, 'ab') as f:
+                        f.seek(0, 2)
+                        offset = f.tell()
+                        f.write(data)
+                    fi.write(self.RECORD.pack(key, offset, len(data)))
+            finally:
+                fi.flush()
+                fcntl.flock(fi.fileno(), fcntl.LOCK_UN)
+        self.readIndex(pack)
+
+    def put(self, data, key = None):
+        if key is None:
+            key = os.urandom(20)
+        with self.locked():
+            if not key in self.index:
+                self.writeRecord(self.activePack(len(data)), key, data)
+        return self.ref(key)
+
+    def find(self, key):
+        if not key in self.index:
+            self.refresh()
+        return self.index.get(key)
+
+    def read(self, ref):
+        key = self.refKey(ref)
+        with self.locked():
+            entry = self.find(key)
+            if entry is None:
+                raise PackStoreException("Cant find '%s'" % ref)
+            (pack_no, offset, size) = entry
+            return self.packs[pack_no].view(offset, size)
+
+    def contains(self, ref):
+        with self.locked():
+            return not self.find(self.refKey(ref)) is None
+
+    def remove(self, ref):
+        key = self.refKey(ref)
+        with self.locked():
+            entry = self.find(key)
+            if entry is None:
+                return False
+            self.writeRecord(self.packs[entry[0]], key)
+        return True
+
+    def compact(self, min_dead_ratio = 0.5):
+        reclaimed = 0
+        with self.locked(fcntl.LOCK_EX) as f:
+            self.refresh()
+            sealed = set()
+            for pack in self.packs.values():
+                total = pack.live_bytes + pack.dead_bytes
+                if total and pack.dead_bytes >= total * min_dead_ratio:
+                    sealed.add(pack.pack_no)
+            for pack_no in sorted(sealed):
+                pack = self.packs[pack_no]
+                # moving the live blobs out counts them as dead too
+                dead_bytes = pack.dead_bytes
+                entries = sorted([(offset, key, size) for (key, (no, offset, size)) in self.index.items()\
+                        if no == pack_no])
+                for (offset, key, size) in entries:
+                    data = bytes(pack.view(offset, size))
+                    self.writeRecord(self.activePack(size, sealed), key, data)
+                # live blobs are in a newer pack now, which wins on reload
+                for file_path in (pack.data_path, pack.index_path):
+                    try:
+                        unlink(file_path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                del self.packs[pack_no]
+                reclaimed += dead_bytes
+            if sealed:
+                self.generation += 1
+                f.seek(0)
+                f.truncate()
+                f.write(str(self.generation))
+                f.flush()
+        return reclaimed
+
+    def stats(self):
+        with self.locked():
+            return {
+                'packs': len(self.packs),
+                'blobs': len(self.index),
+                'live_bytes': sum([p.live_bytes for p in self.packs.values()]),
+                'dead_bytes': sum([p.dead_bytes for p in self.packs.values()])
+            }
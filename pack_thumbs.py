@@ -0,0 +1,79 @@
+import sys
+import hashlib
+from os import path
+
+from sqlalchemy import select, bindparam
+
+from file_image import FileProcess
+from pack_store import isPackRef
+from model import Image, FileRef
+
+def packFile(store, file_path):
+    full_path = FileProcess.fullPath(file_path)
+    if not path.isfile(full_path):
+        return None
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    key = None
+    if FileProcess.storage == FileProcess.STORE_HASH:
+        key = hashlib.sha1(data).digest()
+    return store.put(data, key)
+
+def migrateThumbs(session, batch_size = 1000):
+    store = FileProcess.packStore()
+    table = Image.__table__
+    # a thumbnail can be shared by several images, later ones reuse the first ref
+    refs = {}
+    moved = 0
+    last_id = None
+    while True:
+        q = select(table.c.image_id, table.c.thumb_path).where(table.c.thumb_path != None).\
+                order_by(table.c.image_id).limit(batch_size)
+        if not last_id is None:
+            q = q.where(table.c.image_id > last_id)
+        rows = session.execute(q).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        old_files = []
+        deltas = {}
+        for (image_id, old_path) in rows:
+            if isPackRef(old_path):
+                continue
+            ref = refs.get(old_path)
+            if ref is None:
+                ref = packFile(store, old_path)
+                if ref is None:
+                    continue
+                refs[old_path] = ref
+                old_files.append(old_path)
+                moved += 1
+            updates.append({'b_image_id': image_id, 'b_thumb_path': ref})
+            deltas[old_path] = deltas.get(old_path, 0) - 1
+            deltas[ref] = deltas.get(ref, 0) + 1
+        if updates:
+            session.execute(table.update().where(table.c.image_id == bindparam('b_image_id')).\
+                    values(thumb_path = bindparam('b_thumb_path')), updates)
+        if FileProcess.storage == FileProcess.STORE_HASH:
+            # the old file may still be shared with an image_path, unreferenced ones are left to the file GC
+            FileRef.adjust(session, deltas)
+            old_files = []
+        session.commit()
+        FileProcess.removeFiles(old_files)
+    return moved
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'migrate':
+        from conn import session
+        print('moved %d thumbnails' % migrateThumbs(session))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'compact':
+        ratio = 0.5
+        if len(sys.argv) == 3:
+            ratio = float(sys.argv[2])
+        print('reclaimed %d bytes' % FileProcess.packStore().compact(ratio))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'stats':
+        print(FileProcess.packStore().stats())
+    else:
+        print('usage: pack_thumbs.py migrate | compact [DEAD_RATIO] | stats')
+        sys.exit(1)
@@ -0,0 +1,79 @@
+import re
+import sys
+from os import path, link, utime
+
+from sqlalchemy import select, bindparam
+
+from file_image import FileProcess
+from model import file_columns
+
+HASH_NAME = re.compile(r'^[0-9a-f]{40}\.')
+
+def rebalancePath(fp, file_path, from_levels, to_levels):
+    p = file_path.split(path.sep)
+    if len(p) < from_levels + 1 or HASH_NAME.match(p[-1]):
+        return None
+    prefix = p[:len(p) - from_levels - 1]
+    while True:
+        new_p = prefix + fp.randomDirs(to_levels)
+        fp.makeDirs(new_p)
+        new_path = path.join(*(new_p + [p[-1]]))
+        if not path.isfile(fp.fullPath(new_path)):
+            return new_path
+
+def rebalanceBatch(session, fp, column, rows, from_levels, to_levels, moved_paths):
+    updates = []
+    old_files = []
+    for (row_id, old_path) in rows:
+        new_path = moved_paths.get(old_path)
+        if new_path is None:
+            if not path.isfile(fp.fullPath(old_path)):
+                continue
+            new_path = rebalancePath(fp, old_path, from_levels, to_levels)
+            if new_path is None:
+                continue
+            # keep the old name alive until the new one is committed
+            link(fp.fullPath(old_path), fp.fullPath(new_path))
+            # the new name is unreferenced until commit, don't let the file GC see an old mtime
+            utime(fp.fullPath(new_path), None)
+            moved_paths[old_path] = new_path
+            old_files.append(old_path)
+        updates.append({'b_row_id': row_id, 'b_path': new_path})
+    if updates:
+        pk = list(column.table.primary_key.columns)[0]
+        session.execute(column.table.update().where(pk == bindparam('b_row_id')).\
+                values({column.name: bindparam('b_path')}), updates)
+    return old_files
+
+def rebalanceFiles(session, from_levels, to_levels, batch_size = 1000):
+    fp = FileProcess()
+    moved = 0
+    # a path can be in several rows and columns, later ones follow the first move
+    moved_paths = {}
+    for (cls, keys) in file_columns.items():
+        table = cls.__table__
+        pk = list(table.primary_key.columns)[0]
+        for key in keys:
+            column = table.c[key]
+            last_id = None
+            while True:
+                q = select(pk, column).where(column != None).order_by(pk).limit(batch_size)
+                if not last_id is None:
+                    q = q.where(pk > last_id)
+                rows = session.execute(q).fetchall()
+                if not rows:
+                    break
+                old_files = rebalanceBatch(session, fp, column, rows, from_levels, to_levels, moved_paths)
+                session.commit()
+                FileProcess.removeFiles(old_files)
+                moved += len(old_files)
+                last_id = rows[-1][0]
+    return moved
+
+if __name__ == '__main__':
+    from conn import session
+    if len(sys.argv) < 3:
+        print('usage: rebalance_files.py FROM_LEVELS TO_LEVELS')
+        sys.exit(1)
+    moved = rebalanceFiles(session, int(sys.argv[1]), int(sys.argv[2]))
+    print('moved %d files' % moved)
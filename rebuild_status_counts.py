@@ -0,0 +1,6 @@
+from model import EventStatusCount
+
+if __name__ == '__main__':
+    from conn import session
+    EventStatusCount.rebuild(session)
+    print('event status counts rebuilt')
@@ -0,0 +1,50 @@
+import sys
+
+from file_image import FileProcess, ImageInfo, openImage
+from model import Image, ImageType
+
+def reencodeThumbs(session, image_type = None, batch_size = 100):
+    fp = FileProcess()
+    done = 0
+    last_id = None
+    while True:
+        q = session.query(Image).filter(Image.image_path != None).order_by(Image.image_id)
+        if not image_type is None:
+            q = q.filter(Image.image_type_id == image_type.image_type_id)
+        if not last_id is None:
+            q = q.filter(Image.image_id > last_id)
+        images = q.limit(batch_size).all()
+        if not images:
+            break
+        for img in images:
+            it = img.image_type
+            source_file = FileProcess.fullPath(img.image_path)
+            im = openImage(source_file)
+            if im is None:
+                continue
+            source_info = ImageInfo(source_file, im)
+            if not source_info.is_image():
+                continue
+            thumb_info = fp.storeThumb(source_file, im, source_info, it.thumb_transform_image,\
+                    fp.imageDir(it.base_dir), it.encoding_profile)
+            if thumb_info is None:
+                continue
+            # the old thumbnail goes away with the file_column listener on commit
+            img.setThumbInfo(thumb_info)
+            done += 1
+        last_id = images[-1].image_id
+        session.commit()
+    return done
+
+if __name__ == '__main__':
+    from conn import session
+    image_type = None
+    if len(sys.argv) == 2:
+        image_type = ImageType.find(session, int(sys.argv[1]))
+        if image_type is None:
+            print("Cant find image type %s" % sys.argv[1])
+            sys.exit(1)
+    elif len(sys.argv) != 1:
+        print('usage: reencode_thumbs.py [IMAGE_TYPE_ID]')
+        sys.exit(1)
+    print('reencoded %d thumbnails' % reencodeThumbs(session, image_type))
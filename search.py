@@ -0,0 +1,256 @@
+import re
+import sys
+import weakref
+from sqlalchemy import MetaData, Table, Column, Integer, String, Text, DateTime, Index, text, inspect
+from sqlalchemy import event as alchemy_event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from model import Event, Person, Place, dayStart, dayEnd
+
+KIND_EVENT = 1
+KIND_PERSON = 2
+KIND_PLACE = 3
+
+search_metadata = MetaData()
+
+# native full-text table for MySQL, SQLite uses the FTS5 tables created in install()
+search_docs = Table('search_docs', search_metadata,
+    Column('kind', Integer, primary_key=True, autoincrement=False),
+    Column('ref_id', Integer, primary_key=True, autoincrement=False),
+    Column('title', String(255)),
+    Column('body', Text),
+    Column('time_start', DateTime),
+    Index('ix_search_docs_text', 'title', 'body', mysql_prefix='FULLTEXT'),
+    mysql_engine='InnoDB'
+)
+
+class Document:
+    def __init__(self, kind, cls, fields, mk_doc):
+        self.kind = kind
+        self.cls = cls
+        # one FTS5 table per kind, keyed by rowid = ref_id
+        self.fts_table = 'search_' + cls.__tablename__
+        self.fields = fields
+        self.mk_doc = mk_doc
+
+    def refId(self, obj):
+        return getattr(obj, self.cls.__mapper__.primary_key[0].key)
+
+    def row(self, obj):
+        (title, body, time_start) = self.mk_doc(obj)
+        return {'kind': self.kind, 'ref_id': self.refId(obj), 'title': title or '', 'body': body or '',\
+                'time_start': time_start}
+
+    def changed(self, obj):
+        for field in self.fields:
+            if get_history(obj, field).has_changes():
+                return True
+        return False
+
+documents = {
+    Event: Document(KIND_EVENT, Event, ['title', 'description', 'time_start'],\
+            lambda e: (e.title, e.description, e.time_start)),
+    Person: Document(KIND_PERSON, Person, ['name'],\
+            lambda p: (p.name, None, None)),
+    Place: Document(KIND_PLACE, Place, ['title_name', 'address'],\
+            lambda p: (p.title_name, p.address, None))
+}
+
+kind_documents = dict([(doc.kind, doc) for doc in documents.values()])
+
+def isSqlite(bind):
+    return bind.dialect.name == 'sqlite'
+
+def timeValue(bind, value):
+    if value is None or not isSqlite(bind):
+        return value
+    return str(value)
+
+# engines already checked for the search tables
+engine_tables = weakref.WeakKeyDictionary()
+
+def hasTables(conn):
+    engine = conn.engine
+    if not engine in engine_tables:
+        name = kind_documents[KIND_EVENT].fts_table if isSqlite(conn) else search_docs.name
+        engine_tables[engine] = inspect(conn).has_table(name)
+    return engine_tables[engine]
+
+def install(engine):
+    if isSqlite(engine):
+        with engine.begin() as conn:
+            for doc in documents.values():
+                conn.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5('
+                        'title, body, time_start UNINDEXED)' % doc.fts_table))
+    else:
+        search_metadata.create_all(engine)
+    engine_tables[engine] = True
+    enable()
+
+def enable():
+    if not installed():
+        alchemy_event.listen(Session, 'after_flush', search_after_flush)
+
+def installed():
+    return alchemy_event.contains(Session, 'after_flush', search_after_flush)
+
+def uninstall():
+    if installed():
+        alchemy_event.remove(Session, 'after_flush', search_after_flush)
+
+def deleteDocs(conn, kind, ref_ids):
+    if not ref_ids:
+        return
+    if isSqlite(conn):
+        sql = 'DELETE FROM %s WHERE rowid = :ref_id' % kind_documents[kind].fts_table
+    else:
+        sql = 'DELETE FROM search_docs WHERE kind = :kind AND ref_id = :ref_id'
+    conn.execute(text(sql), [{'kind': kind, 'ref_id': ref_id} for ref_id in ref_ids])
+
+def insertDocs(conn, rows):
+    if not rows:
+        return
+    if isSqlite(conn):
+        for row in rows:
+            row['time_start'] = timeValue(conn, row['time_start'])
+        for (kind, doc) in kind_documents.items():
+            kind_rows = [row for row in rows if row['kind'] == kind]
+            if kind_rows:
+                conn.execute(text('INSERT INTO %s (rowid, title, body, time_start) '
+                        'VALUES (:ref_id, :title, :body, :time_start)' % doc.fts_table), kind_rows)
+    else:
+        conn.execute(search_docs.insert(), rows)
+
+def updateDocs(session, cls, ref_ids, batch_size = 500):
+    # for rows written with Core statements, which the flush listener never sees
+    conn = session.connection()
+    if not hasTables(conn):
+        return
+    doc = documents[cls]
+    pk = cls.__mapper__.primary_key[0]
+    ref_ids = list(ref_ids)
+    for start in range(0, len(ref_ids), batch_size):
+        part = ref_ids[start:start + batch_size]
+        deleteDocs(conn, doc.kind, part)
+        insertDocs(conn, [doc.row(row) for row in session.query(*cls.__table__.c).filter(pk.in_(part))])
+
+def search_after_flush(session, flush_context):
+    conn = session.connection()
+    if not hasTables(conn):
+        return
+    for (cls, doc) in documents.items():
+        rows = []
+        removed = []
+        for obj in session.new:
+            if type(obj) is cls:
+                rows.append(doc.row(obj))
+        for obj in session.dirty:
+            if type(obj) is cls and doc.changed(obj):
+                removed.append(doc.refId(obj))
+                rows.append(doc.row(obj))
+        for obj in session.deleted:
+            if type(obj) is cls:
+                removed.append(doc.refId(obj))
+        deleteDocs(conn, doc.kind, removed)
+        insertDocs(conn, rows)
+
+def ftsQuery(query):
+    words = re.findall(r'\w+', query, re.UNICODE)
+    return ' '.join(['"%s"' % w for w in words])
+
+class SearchHit:
+    def __init__(self, kind, ref_id, score):
+        self.kind = kind
+        self.ref_id = ref_id
+        self.score = score
+        self.obj = None
+
+    def __repr__(self):
+        return "SearchHit(%s, %s, %s)" % (self.kind, self.ref_id, self.score)
+
+def search(session, query, kinds = None, date_from = None, date_to = None, limit = 20, offset = 0):
+    conn = session.connection()
+    params = {'limit': limit, 'offset': offset}
+    where = []
+    if not date_from is None:
+        where.append('time_start >= :date_from')
+        params['date_from'] = timeValue(conn, dayStart(date_from))
+    if not date_to is None:
+        where.append('time_start < :date_to')
+        params['date_to'] = timeValue(conn, dayEnd(date_to))
+    if isSqlite(conn):
+        params['query'] = ftsQuery(query)
+        if not params['query']:
+            return []
+        parts = []
+        for (kind, doc) in sorted(kind_documents.items()):
+            if kinds and not kind in kinds:
+                continue
+            parts.append('SELECT %d AS kind, rowid AS ref_id, -bm25(%s) AS score FROM %s WHERE %s' %\
+                    (kind, doc.fts_table, doc.fts_table,\
+                    ' AND '.join(['%s MATCH :query' % doc.fts_table] + where)))
+        if not parts:
+            return []
+        sql = ' UNION ALL '.join(parts)
+    else:
+        params['query'] = query
+        where.append('MATCH(title, body) AGAINST (:query)')
+        if kinds:
+            where.append('kind IN (%s)' % ', '.join([str(int(k)) for k in kinds]))
+        sql = 'SELECT kind, ref_id, MATCH(title, body) AGAINST (:query) AS score FROM search_docs WHERE ' +\
+                ' AND '.join(where)
+    sql += ' ORDER BY score DESC LIMIT :limit OFFSET :offset'
+    hits = [SearchHit(kind, ref_id, score) for (kind, ref_id, score) in conn.execute(text(sql), params)]
+    loadHits(session, hits)
+    return hits
+
+def loadHits(session, hits):
+    for (cls, doc) in documents.items():
+        ids = [h.ref_id for h in hits if h.kind == doc.kind]
+        if not ids:
+            continue
+        pk = cls.__mapper__.primary_key[0]
+        objs = dict([(doc.refId(obj), obj) for obj in session.query(cls).filter(pk.in_(ids))])
+        for h in hits:
+            if h.kind == doc.kind:
+                h.obj = objs.get(h.ref_id)
+
+def reindex(session, batch_size = 1000):
+    conn = session.connection()
+    if isSqlite(conn):
+        for doc in documents.values():
+            conn.execute(text('DELETE FROM %s' % doc.fts_table))
+    else:
+        conn.execute(search_docs.delete())
+    count = 0
+    for (cls, doc) in documents.items():
+        pk = cls.__mapper__.primary_key[0]
+        last_id = None
+        while True:
+            q = session.query(*cls.__table__.c).order_by(pk)
+            if not last_id is None:
+                q = q.filter(pk > last_id)
+            rows = q.limit(batch_size).all()
+            if not rows:
+                break
+            insertDocs(conn, [doc.row(row) for row in rows])
+            last_id = doc.refId(rows[-1])
+            count += len(rows)
+    session.commit()
+    return count
+
+# every process that imports search keeps the index in sync, not just the one that ran install()
+enable()
+
+if __name__ == '__main__':
+    from conn import engine, session
+    install(engine)
+    if len(sys.argv) == 2 and sys.argv[1] == 'reindex':
+        print('indexed %d documents' % reindex(session))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'query':
+        for hit in search(session, sys.argv[2]):
+            print('%s %s %.3f %r' % (hit.kind, hit.ref_id, hit.score, hit.obj))
+    else:
+        print('usage: search.py reindex | search.py query TEXT')
+        sys.exit(1)
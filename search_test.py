@@ -0,0 +1,92 @@
+import unittest
+
+import search
+from event_import import EventImporter
+from model import Event, EventType, EventSourceType, Person, Place, startup
+from conn import engine, session
+from datetime import datetime, date
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        search.install(engine)
+        self.et = EventType('search', 'Search')
+        self.place = Place('Green theatre')
+        self.place.address = 'Park street'
+        self.person = Person('Okean Elzy', 1)
+        self.events = []
+        for (title, description, day) in [('Okean Elzy live', 'Big summer concert', 1),\
+                ('Jazz evening', 'Quiet jazz in the green theatre', 2),\
+                ('Summer rock', 'Okean Elzy and friends', 3)]:
+            e = Event(self.et, title)
+            e.description = description
+            e.time_start = datetime(2001, 6, day, 20, 0)
+            e.place = self.place
+            self.events.append(e)
+        self.events[0].persons.append(self.person)
+        session.add_all(self.events)
+        session.commit()
+
+    def tearDown(self):
+        for e in self.events:
+            e.persons = []
+            session.delete(e)
+        session.delete(self.person)
+        session.delete(self.place)
+        session.delete(self.et)
+        session.commit()
+        search.uninstall()
+
+    def testSearch(self):
+        hits = search.search(session, 'okean elzy')
+        self.assertEquals(set([(h.kind, h.ref_id) for h in hits]), set([\
+                (search.KIND_EVENT, self.events[0].event_id), (search.KIND_EVENT, self.events[2].event_id),\
+                (search.KIND_PERSON, self.person.person_id)]))
+        self.assert_(self.person in [h.obj for h in hits])
+        self.assert_(hits[0].score >= hits[-1].score)
+        hits = search.search(session, 'okean', kinds = [search.KIND_EVENT], date_from = date(2001, 6, 2))
+        self.assertEquals([h.obj for h in hits], [self.events[2]])
+        hits = search.search(session, 'green theatre', kinds = [search.KIND_PLACE])
+        self.assertEquals([h.obj for h in hits], [self.place])
+        self.assertEquals(search.search(session, '"*'), [])
+
+        self.events[1].title = 'Blues evening'
+        session.commit()
+        self.assertEquals([h.obj for h in search.search(session, 'blues')], [self.events[1]])
+        self.assertEquals(len(search.search(session, 'evening', kinds = [search.KIND_EVENT])), 1)
+
+        search.uninstall()
+        self.events[1].title = 'Folk evening'
+        session.commit()
+        self.assertEquals(search.search(session, 'folk'), [])
+        self.assert_(search.reindex(session, batch_size = 2) >= 5)
+        self.assertEquals([h.obj for h in search.search(session, 'folk')], [self.events[1]])
+        search.enable()
+
+    def testStartup(self):
+        # a process that never ran install() still keeps the index in sync
+        search.uninstall()
+        startup()
+        self.assert_(search.installed())
+        self.events[2].title = 'Country evening'
+        session.commit()
+        self.assertEquals([h.obj for h in search.search(session, 'country')], [self.events[2]])
+
+    def testImport(self):
+        importer = EventImporter(session, EventSourceType.VK)
+        importer.importLines(['{"source_url": "http://vk.com/search1", "title": "Imported gig", '
+                '"place": "Searchable hall", "persons": ["Searchable band"]}'])
+        e = session.query(Event).filter(Event.source_url == 'http://vk.com/search1').one()
+        self.assertEquals([h.obj for h in search.search(session, 'imported')], [e])
+        self.assertEquals([h.obj for h in search.search(session, 'searchable hall')], [e.place])
+        self.assertEquals([h.obj for h in search.search(session, 'searchable band')], e.persons)
+
+        (place, person) = (e.place, e.persons[0])
+        e.persons = []
+        for obj in (e, place, person):
+            session.delete(obj)
+        session.commit()
+        for query in ('imported', 'searchable'):
+            self.assertEquals(search.search(session, query), [])
+
+if __name__ == '__main__':
+    unittest.main()
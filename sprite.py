@@ -0,0 +1,131 @@
+import sys
+from io import BytesIO
+from os import unlink
+
+from file_image import FileProcess, mkTempFile
+from model import Sprite, Image, LinkDomain, Event, sprite_images
+import Image as PilImage
+
+def loadTile(thumb_path):
+    try:
+        im = PilImage.open(BytesIO(bytes(FileProcess.readFile(thumb_path))))
+        im.load()
+    except (IOError, OSError):
+        return None
+    return im
+
+def packTiles(sizes, max_width = 1024):
+    # shelf packing: tallest first, left to right, a new shelf when the row is full
+    positions = {}
+    (x, y, shelf_height, width) = (0, 0, 0, 0)
+    for (key, (w, h)) in sorted(sizes.items(), key = lambda v: (-v[1][1], -v[1][0], v[0])):
+        if x and x + w > max_width:
+            (x, y, shelf_height) = (0, y + shelf_height, 0)
+        positions[key] = (x, y)
+        x += w
+        width = max(width, x)
+        shelf_height = max(shelf_height, h)
+    return (positions, width, y + shelf_height)
+
+def saveSheet(sheet):
+    temp_file = mkTempFile()
+    try:
+        sheet.save(temp_file, 'PNG', optimize = True)
+        fp = FileProcess()
+        return fp.copyFile(temp_file, short_dir = fp.imageDir('sprites'), ext = '.png')
+    finally:
+        unlink(temp_file)
+
+def upToDate(sprite, members, images):
+    if sprite.stale or not sprite.sprite_path or set(members) != set(images):
+        return False
+    for (image_id, img) in images.items():
+        if members[image_id].thumb_path != img.thumb_path:
+            return False
+    return True
+
+def updateSheet(session, sprite, members, images):
+    changed = [img for (image_id, img) in images.items() if members[image_id].thumb_path != img.thumb_path]
+    tiles = dict([(img.image_id, loadTile(img.thumb_path)) for img in changed])
+    for (image_id, tile) in tiles.items():
+        row = members[image_id]
+        if tile is None or tile.size != (row.width, row.height):
+            return False
+    sheet = loadTile(sprite.sprite_path)
+    if sheet is None:
+        return False
+    for (image_id, tile) in tiles.items():
+        row = members[image_id]
+        sheet.paste(tile.convert('RGBA'), (row.x, row.y))
+        session.execute(sprite_images.update().where(sprite_images.c.sprite_id == sprite.sprite_id).\
+                where(sprite_images.c.image_id == image_id).values(thumb_path = images[image_id].thumb_path))
+    sprite.sprite_path = saveSheet(sheet)
+    return True
+
+def buildSheet(session, sprite, images, max_width):
+    tiles = {}
+    for (image_id, img) in images.items():
+        tile = loadTile(img.thumb_path)
+        if not tile is None:
+            tiles[image_id] = tile
+    (positions, width, height) = packTiles(dict([(k, t.size) for (k, t) in tiles.items()]), max_width)
+    sheet = PilImage.new('RGBA', (max(width, 1), max(height, 1)), (0, 0, 0, 0))
+    rows = []
+    for (image_id, tile) in tiles.items():
+        (x, y) = positions[image_id]
+        sheet.paste(tile.convert('RGBA'), (x, y))
+        rows.append({'sprite_id': sprite.sprite_id, 'image_id': image_id, 'x': x, 'y': y,\
+                'width': tile.size[0], 'height': tile.size[1], 'thumb_path': images[image_id].thumb_path})
+    session.execute(sprite_images.delete().where(sprite_images.c.sprite_id == sprite.sprite_id))
+    if rows:
+        session.execute(sprite_images.insert(), rows)
+    sprite.sprite_path = saveSheet(sheet)
+    (sprite.width, sprite.height) = sheet.size
+
+def buildSprite(session, name, images, max_width = 1024):
+    sprite = Sprite.findByName(session, name)
+    if sprite is None:
+        sprite = Sprite(name)
+        session.add(sprite)
+        session.flush()
+    images = dict([(img.image_id, img) for img in images if not img is None and img.thumb_path])
+    members = sprite.members(session)
+    if upToDate(sprite, members, images):
+        return sprite
+    incremental = sprite.sprite_path and set(members) == set(images)
+    if not incremental or not updateSheet(session, sprite, members, images):
+        buildSheet(session, sprite, images, max_width)
+    sprite.stale = False
+    return sprite
+
+def rebuildStale(session, max_width = 1024):
+    sprites = session.query(Sprite).filter(Sprite.stale == True).all()
+    for sprite in sprites:
+        ids = list(sprite.members(session).keys())
+        images = session.query(Image).filter(Image.image_id.in_(ids)).all() if ids else []
+        buildSprite(session, sprite.name, images, max_width)
+    session.commit()
+    return len(sprites)
+
+def domainImages(session):
+    return [d.domain_image for d in session.query(LinkDomain).filter(LinkDomain.domain_image_id != None)]
+
+def eventImages(event):
+    return [p.thumb_image for p in event.persons] + [l.link_domain.domain_image for l in event.links\
+            if not l.link_domain is None]
+
+if __name__ == '__main__':
+    from conn import session
+    if len(sys.argv) == 2 and sys.argv[1] == 'domains':
+        sprite = buildSprite(session, 'link_domains', domainImages(session))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'event':
+        event = session.query(Event).filter(Event.event_id == int(sys.argv[2])).one()
+        sprite = buildSprite(session, 'event-%s' % event.event_id, eventImages(event))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'stale':
+        print('rebuilt %d sprites' % rebuildStale(session))
+        sys.exit(0)
+    else:
+        print('usage: sprite.py domains | event EVENT_ID | stale')
+        sys.exit(1)
+    session.commit()
+    print(sprite.manifest(session))
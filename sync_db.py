@@ -21,7 +21,7 @@ it.base_dir = 'event';
 session.add(it)
 
 for e in session.query(EventType):
-    print e
+    print(e)
 
 event_type = e
 e = Event(event_type, 'First')
@@ -30,6 +30,6 @@ session.add(e)
 
 session.commit()
 
-print e.event_id
-print e.main_image
-print e.time_start
+print(e.event_id)
+print(e.main_image)
+print(e.time_start)